@@ -1,33 +1,36 @@
 from altair import Bin
 from numpy import tri
 import streamlit as st
-import pickle
 import json
 import os
 import random
 import time
 import re
 import hashlib
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Iterator, Optional
 from streamlit_chat import message
 from dotenv import load_dotenv
 from datetime import datetime
 from supabase_utils import init_supabase_client, update_user_profile, get_user_profile
+from intent_utils import CentroidIntentClassifier
+from cache_utils import CachedTextEmbedder, OcrCache, SemanticAnswerCache
+from embedding_utils import BatchingEmbeddingService, OnnxEmbeddingBackend, document_embedder_batch_fn
+from audio_utils import TranscriptionPool, TranscriptionQueueFull
+from loader_utils import ModelRegistry
+from image_utils import OCR, ImagePreprocessor, content_digest
+from math_utils import SymbolicSolver, verify_solution
+from gemini_utils import INTERACTIVE, PROACTIVE, GeminiCallError, GeminiClient, TokenBucketLimiter, resolve_routes
+from corpus_utils import ANN_INDEX_FILE, corpus_exists, load_corpus, load_pickle_corpus
+from retrieval_utils import BM25Index, ContextPacker, HybridRetriever, IVFIndex, NumpyEmbeddingRetriever
 from supabase import Client
-from sympy import Rem
-from PIL import Image
-import io
-from faster_whisper import WhisperModel
-import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 load_dotenv()
 
 # Haystack imports
 from haystack import Pipeline, Document
-from haystack.document_stores.in_memory import InMemoryDocumentStore
-from haystack.components.retrievers.in_memory import InMemoryBM25Retriever, InMemoryEmbeddingRetriever
 from haystack.components.builders import PromptBuilder
-from haystack.components.embedders import SentenceTransformersDocumentEmbedder, SentenceTransformersTextEmbedder
+from haystack.components.embedders import SentenceTransformersDocumentEmbedder
 
 # Google AI integration - Custom Component
 import google.generativeai as genai
@@ -37,10 +40,16 @@ from haystack import component, default_from_dict, default_to_dict
 class CustomGoogleAIGenerator:
     """
     Một component Haystack tùy chỉnh để gọi trực tiếp API Gemini của Google.
+    Mỗi agent được định tuyến tới model và cấu hình sinh riêng (`routes`, xem gemini_utils.AGENT_ROUTES);
+    agent không có route riêng dùng route "default" (model `model_name`).
     """
-    def __init__(self, api_key: str, model_name: str = "gemini-1.5-pro"):
+    def __init__(self, api_key: str, model_name: str = "gemini-1.5-pro", image_preprocessor: Optional[ImagePreprocessor] = None, client: Optional[GeminiClient] = None, routes: Optional[Dict[str, Dict[str, Any]]] = None):
         self.api_key = api_key
         self.model_name = model_name
+        self.image_preprocessor = image_preprocessor or ImagePreprocessor()
+        self.client = client or GeminiClient()
+        self.routes = resolve_routes({"default": {"model_name": model_name}, **(routes or {})})
+        self._route_models: Dict[str, Any] = {}
         genai.configure(api_key=self.api_key)
         
         self.safety_settings = [
@@ -50,46 +59,90 @@ class CustomGoogleAIGenerator:
             {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
         ]
 
-        self.generation_config = genai.types.GenerationConfig(
-            temperature=0.2,
-            max_output_tokens=1024 
-        )
+        self.model = self._model_for("default")
+
 
-        self.model = genai.GenerativeModel(
-            self.model_name,
-            generation_config=self.generation_config,
-            safety_settings=self.safety_settings 
+    def to_dict(self):
+        # Lưu cả bảng route đã gộp để from_dict khôi phục đúng model/cấu hình sinh của từng agent
+        return default_to_dict(
+            self, api_key=self.api_key, model_name=self.model_name,
+            routes={agent: dict(route) for agent, route in self.routes.items()}
         )
 
+    def _route(self, agent: str) -> Dict[str, Any]:
+        return self.routes.get(agent, self.routes["default"])
 
-    def to_dict(self):
-        return default_to_dict(self, api_key=self.api_key, model_name=self.model_name)
+    def _model_for(self, agent: str) -> Any:
+        """GenerativeModel của route ứng với agent (tạo một lần rồi dùng lại)."""
+        model = self._route_models.get(agent)
+        if model is None:
+            route = self._route(agent)
+            generation_config = genai.types.GenerationConfig(
+                **{key: value for key, value in route.items() if key != "model_name"}
+            )
+            model = genai.GenerativeModel(
+                route["model_name"],
+                generation_config=generation_config,
+                safety_settings=self.safety_settings
+            )
+            self._route_models[agent] = model
+        return model
 
     @classmethod
     def from_dict(cls, data):
         return default_from_dict(cls, data)
 
-    @component.output_types(replies=List[str])
-    def run(self, prompt_parts: List[Any]): 
+    def _prepare_parts(self, prompt_parts: List[Any]) -> List[Any]:
+        """Chuyển các phần bytes (ảnh) thành blob JPEG đã thu nhỏ (có cache) để gửi cho Gemini."""
+        processed_parts = []
+        for part in prompt_parts:
+            if isinstance(part, bytes): 
+                try:
+                    processed_parts.append(self.image_preprocessor.prepare(part))
+                except Exception as e:
+                    print(f"Lỗi khi xử lý ảnh: {e}")
+            else:
+                processed_parts.append(part) 
+        return processed_parts
+
+    @component.output_types(replies=List[str], meta=Dict[str, Any], error=Optional[Dict[str, Any]])
+    def run(self, prompt_parts: List[Any], agent: str = "default", priority: Optional[int] = None): 
         """
-        Gửi một prompt đa phương thức (văn bản và hình ảnh) đến API Gemini.
+        Gửi một prompt đa phương thức (văn bản và hình ảnh) đến API Gemini qua client dùng chung.
+        Khi lỗi, `replies` rỗng và `error` mô tả loại lỗi (timeout, rate_limited, unavailable, ...).
+        `priority` là làn của bộ giới hạn quota (mặc định theo agent).
         """
-        try:
-            processed_parts = []
-            for part in prompt_parts:
-                if isinstance(part, bytes): 
-                    try:
-                        img = Image.open(io.BytesIO(part))
-                        processed_parts.append(img)
-                    except Exception as e:
-                        print(f"Lỗi khi xử lý ảnh: {e}")
-                else:
-                    processed_parts.append(part) 
+        return self.client.generate(
+            self._model_for(agent), self._prepare_parts(prompt_parts), agent=agent, priority=priority,
+            output_tokens=self._route(agent)["max_output_tokens"]
+        )
 
-            response = self.model.generate_content(processed_parts)
-            return {"replies": [response.text]}
-        except Exception as e:
-            return {"replies": [f"Xin lỗi, đã có lỗi xảy ra khi kết nối với mô hình AI."]}
+    def stream(self, prompt_parts: List[Any], agent: str = "default", priority: Optional[int] = None) -> Iterator[str]:
+        """
+        Giống `run` nhưng trả về từng đoạn văn bản ngay khi Gemini sinh ra (streaming).
+        Lỗi được ném ra dưới dạng GeminiCallError.
+        """
+        yield from self.client.stream(
+            self._model_for(agent), self._prepare_parts(prompt_parts), agent=agent, priority=priority,
+            output_tokens=self._route(agent)["max_output_tokens"]
+        )
+
+def generate_reply(resources: Dict, prompt_parts: List[Any], on_token: Optional[Callable[[str], None]] = None, agent: str = "default", priority: Optional[int] = None) -> str:
+    """
+    Gọi generator và trả về câu trả lời đầy đủ; ném GeminiCallError nếu lượt gọi thất bại.
+    Nếu có `on_token`, câu trả lời được stream và callback nhận phần văn bản đã có sau mỗi đoạn.
+    """
+    if on_token is None:
+        result = resources["generator"].run(prompt_parts=prompt_parts, agent=agent, priority=priority)
+        if result["error"]:
+            raise GeminiCallError(result["error"])
+        return result["replies"][0]
+
+    answer = ""
+    for chunk in resources["generator"].stream(prompt_parts, agent=agent, priority=priority):
+        answer += chunk
+        on_token(answer)
+    return answer
 
 st.set_page_config(
     page_title="AI Math Tutor",
@@ -318,19 +371,119 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Chạy verifier trong nền: hiển thị lời giải ngay, chú thích lại nếu verifier phát hiện lỗi
+BACKGROUND_VERIFICATION = os.getenv("BACKGROUND_VERIFICATION", "1") == "1"
+# Thời gian tối đa chờ verifier nền trước khi rerun giao diện (giây)
+VERIFICATION_WAIT_SECONDS = 30
+# Thời gian tối đa chờ truy xuất suy đoán đang chạy trước khi tự truy xuất lại (giây)
+SPECULATIVE_RETRIEVAL_WAIT_SECONDS = 5
+# Giải ngay bằng sympy các bài tính toán cơ bản (phương trình, hệ, bất phương trình, biểu thức căn), không gọi Gemini
+SYMBOLIC_FAST_PATH = os.getenv("SYMBOLIC_FAST_PATH", "1") == "1"
+
+# Cấu hình nhận dạng giọng nói
+WHISPER_BEAM_SIZE = int(os.getenv("WHISPER_BEAM_SIZE", "5"))
+WHISPER_BATCHED = os.getenv("WHISPER_BATCHED", "0") == "1"
+# Nạp Whisper trong nền sau khi embedder sẵn sàng; nếu tắt thì chỉ nạp ở lần dùng giọng nói đầu tiên
+WHISPER_PRELOAD = os.getenv("WHISPER_PRELOAD", "1") == "1"
+# Pool tiến trình nhận dạng giọng nói: số worker, số thread CPU mỗi worker, số job chờ tối đa và timeout mỗi job
+ASR_WORKERS = int(os.getenv("ASR_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) // 2)))))
+ASR_CPU_THREADS = int(os.getenv("ASR_CPU_THREADS", "2"))
+ASR_MAX_QUEUE = int(os.getenv("ASR_MAX_QUEUE", "8"))
+ASR_TIMEOUT_SECONDS = float(os.getenv("ASR_TIMEOUT_SECONDS", "120"))
+
 # Kiểm tra API key
 if "GOOGLE_API_KEY" not in os.environ:
     st.error("⚠️ Không tìm thấy API key. Vui lòng cấu hình biến môi trường.")
     st.stop()
 
+@st.cache_resource
+def get_background_executor() -> ThreadPoolExecutor:
+    """Thread pool dùng chung giữa các phiên cho các tác vụ chạy nền (verifier, ...)."""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="background-agent")
+
+@st.cache_resource
+def get_retrieval_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool riêng cho truy xuất suy đoán: không xếp hàng sau các job verifier nền
+    (có thể chờ tới hàng chục giây trong làn ưu tiên thấp của rate limiter).
+    """
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="speculative-retrieval")
+
+def _load_text_embedder() -> CachedTextEmbedder:
+    """Nạp vietnamese-bi-encoder, đặt sau hàng đợi batch và cache LRU."""
+    if os.getenv("EMBEDDING_BACKEND", "torch") == "onnx":
+        # Backend ONNX Runtime int8 (python embedding_utils.py export-onnx), không cần torch
+        print("DEBUG: Loading ONNX embedding backend...")
+        embed_batch = OnnxEmbeddingBackend(os.getenv("ONNX_MODEL_DIR", "onnx_model")).embed_batch
+        print("DEBUG: ONNX embedding backend loaded successfully")
+    else:
+        batch_embedder = SentenceTransformersDocumentEmbedder(
+            model="bkai-foundation-models/vietnamese-bi-encoder",
+            batch_size=32,
+            progress_bar=False
+        )
+        
+        # Warm up the text embedder to load the model
+        print("DEBUG: Warming up text embedder...")
+        batch_embedder.warm_up()
+        print("DEBUG: Text embedder warmed up successfully")
+        embed_batch = document_embedder_batch_fn(batch_embedder)
+
+    # Gom request embedding của mọi phiên thành batch, đặt cache LRU phía trước
+    embedding_service = BatchingEmbeddingService(embed_batch=embed_batch, max_batch_size=32)
+    return CachedTextEmbedder(embedding_service)
+
+def _load_transcription_pool() -> TranscriptionPool:
+    print(f"DEBUG: Starting {ASR_WORKERS} Faster Whisper worker(s) with {ASR_CPU_THREADS} CPU thread(s) each...")
+    model_size = "small" 
+
+    # Chạy trên CPU với INT8 để tối ưu, mỗi worker là một tiến trình riêng
+    asr_pool = TranscriptionPool(
+        model_size=model_size,
+        compute_type="int8",
+        workers=ASR_WORKERS,
+        cpu_threads=ASR_CPU_THREADS,
+        max_queue=ASR_MAX_QUEUE,
+        timeout_seconds=ASR_TIMEOUT_SECONDS,
+    )
+    worker_pids = asr_pool.warm_up()
+
+    print(f"DEBUG: Faster Whisper model '{model_size}' loaded in workers {worker_pids}.")
+    return asr_pool
+
+@st.cache_resource
+def get_model_registry() -> ModelRegistry:
+    """
+    Bắt đầu nạp các model nặng trong nền, dùng chung cho mọi phiên.
+    Không chặn giao diện: trang đăng nhập và chat văn bản hiển thị ngay trong lúc model đang tải.
+    """
+    registry = ModelRegistry()
+    registry.register("text_embedder", _load_text_embedder)
+    # Bộ phân loại intent cục bộ, tránh một lượt gọi Gemini cho các câu dễ
+    registry.register("intent_classifier", lambda: CentroidIntentClassifier(
+        embed_fn=lambda text: registry.get("text_embedder").run(text=text)["embedding"]
+    ))
+    registry.register("asr_pool", _load_transcription_pool)
+
+    registry.start("text_embedder")
+    registry.start("intent_classifier", after=["text_embedder"])
+    if WHISPER_PRELOAD:
+        registry.start("asr_pool", after=["intent_classifier"])
+    return registry
+
 @st.cache_resource
 def load_resources():
-    """Load và khởi tạo tất cả tài nguyên của hệ thống"""
+    """Load và khởi tạo tất cả tài nguyên của hệ thống (các model nặng nằm trong get_model_registry)"""
     
-    # Load documents
+    # Load documents: ưu tiên corpus memmap, dùng file pickle cũ nếu chưa chuyển đổi
+    corpus_dir = os.getenv("CORPUS_DIR", "corpus")
     try:
-        with open("embedded_documents.pkl", "rb") as f:
-            documents = pickle.load(f)
+        if corpus_exists(corpus_dir):
+            corpus = load_corpus(corpus_dir)
+            print(f"DEBUG: Loaded memory-mapped corpus from '{corpus_dir}' ({len(corpus)} documents)")
+        else:
+            corpus = load_pickle_corpus("embedded_documents.pkl")
+            print("DEBUG: Loaded corpus from embedded_documents.pkl")
     except FileNotFoundError:
         st.error("❌ Không tìm thấy dữ liệu học liệu")
         st.stop()
@@ -343,28 +496,23 @@ def load_resources():
         st.error("❌ Không tìm thấy dữ liệu video")
         st.stop()
     
-    # Initialize document store
-    document_store = InMemoryDocumentStore()
-    document_store.write_documents(documents)
-    
     # Initialize components
-    retriever = InMemoryEmbeddingRetriever(document_store=document_store)
-    text_embedder = SentenceTransformersTextEmbedder(
-        model="bkai-foundation-models/vietnamese-bi-encoder"
-    )
-    
-    # Warm up the text embedder to load the model
-    print("DEBUG: Warming up text embedder...")
-    text_embedder.warm_up()
-    print("DEBUG: Text embedder warmed up successfully")
-
-    print("DEBUG: Loading Faster Whisper model...")
-    model_size = "small" 
-
-    # Chạy trên CPU với INT8 để tối ưu
-    whisper_model = WhisperModel(model_size, device="cpu", compute_type="int8")
-
-    print(f"DEBUG: Faster Whisper model '{model_size}' loaded successfully.")
+    # Retriever đọc trực tiếp ma trận embedding của corpus, không cần sao chép vào document store.
+    # Dùng chỉ mục ANN nếu đã được xây offline (python corpus_utils.py build-index)
+    ann_index = None
+    ann_index_path = os.path.join(corpus_dir, ANN_INDEX_FILE)
+    if os.path.exists(ann_index_path):
+        ann_nprobe = os.getenv("ANN_NPROBE")
+        ann_index = IVFIndex.load(ann_index_path, nprobe=int(ann_nprobe) if ann_nprobe else None)
+        print(f"DEBUG: Loaded IVF index ({ann_index.n_lists} lists, nprobe={ann_index.nprobe})")
+    embedding_retriever = NumpyEmbeddingRetriever(corpus=corpus, ann_index=ann_index)
+
+    # Thống kê BM25 được tính một lần ở đây, không tính lại theo từng truy vấn
+    bm25_index = BM25Index(corpus.contents)
+    retriever = HybridRetriever(embedding_retriever=embedding_retriever, bm25_index=bm25_index)
+
+    # Giới hạn phần tài liệu SGK trong prompt của informer (token ước lượng)
+    context_packer = ContextPacker(token_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500")))
     
     # Templates
     informer_template = """
@@ -589,8 +737,25 @@ def load_resources():
     support_prompt_builder = PromptBuilder(template=support_template, required_variables=["master_prompt", "conversation_history"])
     off_topic_prompt_builder = PromptBuilder(template=off_topic_template, required_variables=["master_prompt", "conversation_history"])
     
-    # Create generator
-    generator = CustomGoogleAIGenerator(api_key=os.getenv("GOOGLE_API_KEY"))
+    # Ảnh tải lên được giải mã, xoay, thu nhỏ một lần và dùng lại giữa lượt OCR và lượt giải bài
+    image_preprocessor = ImagePreprocessor(max_side=int(os.getenv("IMAGE_MAX_SIDE", "1600")))
+
+    # Create generator: mọi agent dùng chung một client Gemini (một event loop, một kết nối)
+    # và một bộ giới hạn quota RPM/TPM, câu hỏi của người dùng được ưu tiên hơn tác vụ nền
+    rate_limiter = TokenBucketLimiter(
+        requests_per_minute=float(os.getenv("GEMINI_RPM", "60")),
+        tokens_per_minute=float(os.getenv("GEMINI_TPM", "1000000")),
+    )
+    gemini_client = GeminiClient(max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")), limiter=rate_limiter)
+    generator = CustomGoogleAIGenerator(
+        api_key=os.getenv("GOOGLE_API_KEY"), image_preprocessor=image_preprocessor, client=gemini_client,
+        routes=json.loads(os.getenv("GEMINI_ROUTES", "{}"))
+    )
+
+    # Cache lời giải đã kiểm chứng cho các câu hỏi lặp lại
+    answer_cache = SemanticAnswerCache(path=os.getenv("ANSWER_CACHE_PATH", "answer_cache.sqlite3"))
+    # Cache OCR theo hash nội dung (ảnh tải lại y hệt) và dấu vân ảnh (ảnh lưu/nén lại): không cần gọi lại Gemini OCR
+    ocr_cache = OcrCache(path=os.getenv("OCR_CACHE_PATH", "ocr_cache.sqlite3"))
     
     return {
         "informer_prompt_builder": informer_prompt_builder,
@@ -600,89 +765,100 @@ def load_resources():
         "verifier_prompt_builder": verifier_prompt_builder,
         "intent_prompt_builder": intent_prompt_builder,
         "videos_data": videos_data,
-        "document_store": document_store,
+        "corpus": corpus,
         "tutor_master_prompt": tutor_master_prompt,
         "greeting_prompt_builder": greeting_prompt_builder,
         "stress_prompt_builder": stress_prompt_builder,
         "support_prompt_builder": support_prompt_builder,
         "off_topic_prompt_builder": off_topic_prompt_builder,
         "retriever": retriever,
-        "text_embedder": text_embedder,
-        "whisper_model": whisper_model
+        "context_packer": context_packer,
+        "answer_cache": answer_cache,
+        "image_preprocessor": image_preprocessor,
+        "ocr_cache": ocr_cache,
+        "symbolic_solver": SymbolicSolver() if SYMBOLIC_FAST_PATH else None,
+        "models": get_model_registry()
     }
 
-def transcribe_audio(audio_file, whisper_model: WhisperModel) -> str:
+def transcribe_audio(audio_file, asr_pool: TranscriptionPool) -> str:
     """
     Nhận audio file từ st.audio_input và chuyển đổi thành văn bản bằng Faster Whisper.
-    Phiên bản được cập nhật cho môi trường deployment.
+    Audio được gửi sang pool tiến trình nhận dạng, giải mã trong bộ nhớ, có VAD để bỏ qua khoảng lặng.
     """
     if not audio_file:
         return ""
         
-    tmp_file_path = ""
     try:
         # Đọc audio file từ st.audio_input (UploadedFile object)
         audio_bytes = audio_file.read()
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmpfile:
-            tmpfile.write(audio_bytes)
-            tmp_file_path = tmpfile.name
-        
-        print(f"DEBUG: [Whisper] Audio saved to temp file: {tmp_file_path}")
-        
-        print(f"DEBUG: [Whisper] Transcribing audio from: {tmp_file_path}")
-        segments, info = whisper_model.transcribe(tmp_file_path, beam_size=5, language="vi")
+        queue_depth = asr_pool.queue_depth()
+        if queue_depth > 0:
+            st.info(f"⏳ Có {queue_depth} yêu cầu giọng nói đang chờ trước bạn, vui lòng đợi trong giây lát...")
 
-        print(f"DEBUG: [Whisper] Detected language: {info.language} with probability {info.language_probability}")
-        
-        transcribed_text = " ".join(segment.text for segment in segments)
-        print(f"DEBUG: [Whisper] Transcribed text: '{transcribed_text}'")
-        return transcribed_text.strip()
-            
+        print(f"DEBUG: [Whisper] Transcribing {len(audio_bytes)} bytes in memory (beam_size={WHISPER_BEAM_SIZE}, batched={WHISPER_BATCHED}, queue_depth={queue_depth})")
+        result = asr_pool.transcribe(audio_bytes, beam_size=WHISPER_BEAM_SIZE, batched=WHISPER_BATCHED)
+
+        print(f"DEBUG: [Whisper] Detected language: {result['language']} with probability {result['language_probability']}")
+        print(f"DEBUG: [Whisper] Audio {result['duration']:.1f}s ({result['duration_after_vad']:.1f}s after VAD), "
+              f"took {result['elapsed']:.2f}s, RTF={result['rtf']:.2f}")
+        print(f"DEBUG: [Whisper] Transcribed text: '{result['text']}' (worker {result['worker_pid']})")
+        return result["text"]
+
+    except TranscriptionQueueFull:
+        st.warning("🚦 Hệ thống nhận dạng giọng nói đang quá tải. Vui lòng thử lại sau ít phút hoặc nhập câu hỏi bằng văn bản.")
+        return ""
+    except TimeoutError:
+        st.warning("⌛ Bản ghi âm xử lý quá lâu. Vui lòng ghi âm ngắn hơn hoặc nhập câu hỏi bằng văn bản.")
+        return ""
     except Exception as e:
         st.error(f"Lỗi khi xử lý giọng nói: {e}")
         return ""
-    finally:
-        if tmp_file_path and os.path.exists(tmp_file_path):
-            os.remove(tmp_file_path)
-            print(f"DEBUG: [Whisper] Cleaned up temp file: {tmp_file_path}")
 
 
+def _last_user_message(conversation_history: str) -> str:
+    """Lấy câu cuối cùng của người dùng trong lịch sử chat dạng 'User: ...'."""
+    if 'User: ' in conversation_history:
+        for line in reversed(conversation_history.split('\n')):
+            if line.strip().startswith('User: '):
+                return line.replace('User: ', '').strip()
+    return "N/A"
+
 def classify_intent(conversation_history: str, resources: Dict) -> str:
-    """Phân loại ý định người dùng"""
+    """
+    Phân loại ý định người dùng.
+    Thử bộ phân loại cục bộ trước; chỉ gọi Gemini khi bộ cục bộ không đủ tự tin.
+    """
     valid_intents = ['greeting_social', 'math_question', 'request_for_practice', 'expression_of_stress', 'study_support', 'off_topic']
     
     try:
+        user_input = _last_user_message(conversation_history)
+        # Bộ phân loại cục bộ chỉ dùng khi đã nạp xong, không bắt người dùng chờ model
+        models = resources["models"]
+        local_classifier = models.get("intent_classifier") if models.is_ready("intent_classifier") else None
+        if local_classifier is not None and user_input != "N/A":
+            local_intent, similarity, margin = local_classifier.predict(user_input)
+            if local_classifier.is_confident(similarity, margin):
+                print(f"DEBUG - Local intent: {local_intent} (similarity={similarity:.3f}, margin={margin:.3f})")
+                return local_intent
+            print(f"DEBUG - Local intent not confident ({local_intent}, similarity={similarity:.3f}, margin={margin:.3f}), falling back to LLM")
+
         prompt_builder = resources["intent_prompt_builder"]
         
         prompt_text = prompt_builder.run(conversation_history=conversation_history)["prompt"]
         
-        result = resources["generator"].run(prompt_parts=[prompt_text])
-        intent = result["replies"][0].strip().lower()
+        result = resources["generator"].run(prompt_parts=[prompt_text], agent="intent")
+        if result["error"]:
+            print(f"DEBUG - LLM intent classification failed ({result['error']['type']}), using keyword fallback")
+        intent = result["replies"][0].strip().lower() if result["replies"] else ""
         
-        user_input_debug = "N/A"
-        if 'User: ' in conversation_history: 
-            lines = conversation_history.split('\n')
-            for line in reversed(lines):
-                if line.strip().startswith('User: '): 
-                    user_input_debug = line.replace('User: ', '').strip()
-                    break
-        
-        print(f"DEBUG - User input: {user_input_debug}")
+        print(f"DEBUG - User input: {user_input}")
         print(f"DEBUG - Classified intent: {intent}")
         
         if intent not in valid_intents:
             math_keywords = ['giải', 'tính', 'phương trình', 'bài tập', 'toán', 'xác suất', 'thống kê', 'hình học', 'đại số']
             
-            user_input_for_fallback = "N/A"
-            if 'User: ' in conversation_history:
-                lines = conversation_history.split('\n')
-                for line in reversed(lines):
-                    if line.strip().startswith('User: '):
-                        user_input_for_fallback = line.replace('User: ', '').strip()
-                        break
-            
-            if any(keyword in user_input_for_fallback.lower() for keyword in math_keywords):
+            if any(keyword in user_input.lower() for keyword in math_keywords):
                 intent = 'math_question'
             else:
                 intent = 'greeting_social'
@@ -703,11 +879,14 @@ def informer_agent(query: str, conversation_history_str: str, resources: Dict) -
     except:
         return "Xin lỗi, tôi không thể giải bài này lúc này."
 
-def verifier_agent(query: str, informer_answer: str, resources: Dict) -> Dict:
-    """Agent kiểm tra tính đúng đắn"""
+def verifier_agent(query: str, informer_answer: str, resources: Dict, priority: Optional[int] = None) -> Dict:
+    """Agent kiểm tra tính đúng đắn (mặc định chạy ở làn BACKGROUND; truyền INTERACTIVE khi học sinh đang chờ kết quả)"""
     try:
         prompt_text = resources["verifier_prompt_builder"].run(query=query, informer_answer=informer_answer)["prompt"]
-        result = resources["generator"].run(prompt_parts=[prompt_text])
+        result = resources["generator"].run(prompt_parts=[prompt_text], agent="verifier", priority=priority)
+        if result["error"]:
+            # Không kiểm tra được: không chú thích lời giải và không đưa vào answer cache
+            return {"is_correct": True, "correction_suggestion": "", "error": result["error"]}
         llm_reply_string = result["replies"][0]
 
         json_match = re.search(r"\{.*\}", llm_reply_string, re.DOTALL)
@@ -719,7 +898,7 @@ def verifier_agent(query: str, informer_answer: str, resources: Dict) -> Dict:
         print(f"ERROR: [Verifier Agent] Lỗi: {e}")
         return {"is_correct": True, "correction_suggestion": ""}
 
-def insight_agent(conversation_history: str, resources: Dict) -> Dict:
+def insight_agent(conversation_history: str, resources: Dict, priority: Optional[int] = None) -> Dict:
     """Agent phân tích điểm yếu, với logic trích xuất JSON thông minh."""
     try:
         prompt_builder = resources["insight_prompt_builder"]
@@ -729,7 +908,9 @@ def insight_agent(conversation_history: str, resources: Dict) -> Dict:
         print(prompt_text)
         print("="*50 + "\n")
 
-        result = resources["generator"].run(prompt_parts=[prompt_text])
+        result = resources["generator"].run(prompt_parts=[prompt_text], agent="insight", priority=priority)
+        if result["error"]:
+            return {"misunderstood_concepts": [], "sentiment": "neutral"}
         llm_reply = result["replies"][0]
 
         json_match = re.search(r"\{.*\}", llm_reply, re.DOTALL)
@@ -745,7 +926,7 @@ def insight_agent(conversation_history: str, resources: Dict) -> Dict:
     except Exception as e:
         return {"misunderstood_concepts": [], "sentiment": "neutral"}
 
-def practice_agent(student_weakness: str, resources: Dict) -> str:
+def practice_agent(student_weakness: str, resources: Dict, on_token: Optional[Callable[[str], None]] = None, priority: Optional[int] = None) -> str:
     """Agent tạo bài tập"""
     try:
         video_cheatsheet = []
@@ -762,52 +943,166 @@ def practice_agent(student_weakness: str, resources: Dict) -> str:
             video_cheatsheet_json=video_json
         )["prompt"]
         
-        result = resources["generator"].run(prompt_parts=[prompt_text])
-        return result["replies"][0]
+        return generate_reply(resources, [prompt_text], on_token=on_token, agent="practice", priority=priority)
+    except GeminiCallError as e:
+        return str(e)
     except:
         return "Xin lỗi, tôi không thể tạo bài tập lúc này."
 
+def retrieve_context(query_text: str, resources: Dict) -> List[Document]:
+    """Stage 2 của engine: embedding câu hỏi và truy xuất tài liệu SGK liên quan."""
+    try:
+        print("DEBUG: [Stage 2] Starting RAG retrieval...")
+        embedding = resources["models"].get("text_embedder").run(text=query_text)["embedding"]
+        print("DEBUG: [Stage 2] Embedding created successfully")
+        context_docs = resources["retriever"].run(query=query_text, query_embedding=embedding)["documents"]
+        print(f"DEBUG: [Stage 2] Retrieved {len(context_docs)} documents")
+        return context_docs
+    except Exception as e:
+        print(f"ERROR: [Stage 2] RAG retrieval failed: {e}")
+        return []
+
+def verify_and_cache(query: str, informer_answer: str, resources: Dict, cache_query: str = None, cache_embedding: List[float] = None, priority: Optional[int] = None) -> Dict:
+    """
+    Chạy verifier; nếu lời giải được xác nhận đúng thì lưu vào answer cache.
+    Các dạng bài sympy đọc được (phương trình, hệ, bất phương trình, biểu thức căn) được kiểm tra
+    chính xác tại chỗ; chỉ khi không đọc được đề hoặc đáp số mới gọi verifier LLM.
+    """
+    verification = verify_solution(query, informer_answer)
+    if verification is not None:
+        print(f"DEBUG: [Stage 5] Verified symbolically ({verification['problem_type']}), skipping LLM verifier")
+    else:
+        verification = verifier_agent(query, informer_answer, resources, priority=priority)
+    answer_cache = resources.get("answer_cache")
+    # Chỉ cache khi verifier thực sự trả lời "đúng" (không phải giá trị mặc định khi lỗi/parse thất bại)
+    if (cache_query and answer_cache is not None and verification.get("is_correct") is True
+            and not verification.get("correction_suggestion") and not verification.get("error")):
+        try:
+            answer_cache.store(cache_query, cache_embedding, informer_answer)
+        except Exception as e:
+            print(f"ERROR: [Answer Cache] Could not store answer: {e}")
+    return verification
+
 def problem_solving_engine(
     query_text: str, 
     query_image: bytes, 
     conversation_history_str: str, 
-    resources: Dict
+    resources: Dict,
+    on_token: Optional[Callable[[str], None]] = None,
+    on_verification: Optional[Callable[[Future], None]] = None,
+    prefetched_context: Optional[Future] = None,
+    has_prior_turns: bool = False
 ) -> str:
     """
     Cỗ máy giải quyết vấn đề đa năng, TÁI SỬ DỤNG informer_prompt_builder.
+    Nếu có `on_token`, câu trả lời ở Stage 4 được stream ra UI trong khi Gemini đang sinh.
+    Nếu có `on_verification`, Stage 5 được đẩy sang thread nền: engine trả về lời giải ngay
+    và chuyển Future của verifier cho callback để UI chú thích lại sau.
+    `prefetched_context` là Future của retrieve_context(query_text) đã chạy suy đoán từ trước;
+    chỉ được dùng khi không có ảnh (vì khi đó câu hỏi đầy đủ còn chứa văn bản OCR).
+    `has_prior_turns`: học sinh đã hỏi trước đó trong phiên; câu hỏi có thể phụ thuộc ngữ cảnh
+    ("còn câu b thì sao?") nên không tra cứu/lưu answer cache.
     """
     print("DEBUG: Multimodal Problem-Solving Engine activated.")
     
     try:
         extracted_text_from_image = ""
         if query_image:
-            print("DEBUG: [Stage 1] Image detected. Calling Gemini for OCR...")
-            try:
-                ocr_prompt_parts = [
-                    "Bạn là một hệ thống OCR toán học siêu chính xác. Hãy đọc và trích xuất toàn bộ văn bản từ hình ảnh sau đây. Chỉ trả về phần văn bản được trích xuất.", 
-                    query_image
-                ]
-                ocr_result = resources["generator"].run(prompt_parts=ocr_prompt_parts)
-                extracted_text_from_image = ocr_result["replies"][0]
-                print(f"DEBUG: [Stage 1] Text extracted from image: '{extracted_text_from_image}'")
-            except Exception as e:
-                print(f"ERROR: [Stage 1] OCR failed: {e}")
-                extracted_text_from_image = "Không thể đọc được nội dung từ hình ảnh."
+            print("DEBUG: [Stage 1] Image detected. Checking OCR cache...")
+            ocr_cache = resources.get("ocr_cache")
+            image_key = None
+            if ocr_cache is not None:
+                try:
+                    preprocessor = resources["image_preprocessor"]
+                    image_key = (content_digest(query_image), preprocessor.fingerprint(query_image))
+                    extracted_text_from_image = ocr_cache.lookup(*image_key) or ""
+                    print(f"DEBUG: [Stage 1] OCR cache stats: {ocr_cache.stats()}")
+                except Exception as e:
+                    print(f"ERROR: [Stage 1] OCR cache lookup failed: {e}")
+
+            if extracted_text_from_image:
+                print(f"DEBUG: [Stage 1] OCR cache hit, skipping Gemini OCR: '{extracted_text_from_image}'")
+            else:
+                print("DEBUG: [Stage 1] Calling Gemini for OCR...")
+                try:
+                    # Bản xám, thu nhỏ của ảnh: đủ cho OCR và nhẹ hơn nhiều so với ảnh gốc từ camera
+                    ocr_prompt_parts = [
+                        "Bạn là một hệ thống OCR toán học siêu chính xác. Hãy đọc và trích xuất toàn bộ văn bản từ hình ảnh sau đây. Chỉ trả về phần văn bản được trích xuất.", 
+                        resources["image_preprocessor"].prepare(query_image, purpose=OCR)
+                    ]
+                    ocr_result = resources["generator"].run(prompt_parts=ocr_prompt_parts, agent="ocr")
+                    if ocr_result["error"]:
+                        raise GeminiCallError(ocr_result["error"])
+                    extracted_text_from_image = ocr_result["replies"][0]
+                    print(f"DEBUG: [Stage 1] Text extracted from image: '{extracted_text_from_image}'")
+                except Exception as e:
+                    print(f"ERROR: [Stage 1] OCR failed: {e}")
+                    extracted_text_from_image = "Không thể đọc được nội dung từ hình ảnh."
+                else:
+                    # Lỗi ghi cache không được làm mất văn bản OCR vừa đọc được
+                    if image_key is not None and extracted_text_from_image.strip():
+                        try:
+                            ocr_cache.store(*image_key, extracted_text_from_image)
+                        except Exception as e:
+                            print(f"ERROR: [Stage 1] OCR cache store failed: {e}")
 
         full_query_text = (query_text + " " + extracted_text_from_image).strip()
         print(f"DEBUG: [Stage 1.5] Full query text: '{full_query_text}'")
 
-        context_docs = []
-        if full_query_text:
+        # Bài tính toán cơ bản gõ tay: sympy giải trong vài mili giây, bỏ qua embedding, retrieval, Gemini và verifier.
+        # Đề có ảnh vẫn đi qua Gemini vì văn bản OCR có thể đọc sai.
+        symbolic_solver = resources.get("symbolic_solver")
+        if symbolic_solver is not None and full_query_text and not query_image:
+            symbolic_answer = symbolic_solver.answer(full_query_text)
+            if symbolic_answer:
+                print(f"DEBUG: [Fast Path] Solved symbolically, skipping retrieval and generation: {symbolic_solver.stats()}")
+                if prefetched_context is not None:
+                    prefetched_context.cancel()
+                if on_token is not None:
+                    on_token(symbolic_answer)
+                return symbolic_answer
+
+        # Cache chỉ áp dụng cho câu hỏi thuần văn bản, độc lập với hội thoại (câu hỏi có ảnh phụ thuộc vào
+        # nội dung ảnh, câu hỏi tiếp nối phụ thuộc vào các lượt trước)
+        answer_cache = resources.get("answer_cache")
+        cache_query, cache_embedding = None, None
+        if answer_cache is not None and full_query_text and not query_image and not has_prior_turns:
             try:
-                print("DEBUG: [Stage 2] Starting RAG retrieval...")
-                embedding = resources["text_embedder"].run(text=full_query_text)["embedding"]
-                print("DEBUG: [Stage 2] Embedding created successfully")
-                context_docs = resources["retriever"].run(query_embedding=embedding)["documents"]
-                print(f"DEBUG: [Stage 2] Retrieved {len(context_docs)} documents")
+                cache_embedding = resources["models"].get("text_embedder").run(text=full_query_text)["embedding"]
+                cache_query = full_query_text
+                cached_answer = answer_cache.lookup(full_query_text, cache_embedding)
+                print(f"DEBUG: [Stage 1.6] Answer cache stats: {answer_cache.stats()}")
+                if cached_answer:
+                    print("DEBUG: [Stage 1.6] Answer cache hit, skipping retrieval and generation")
+                    if prefetched_context is not None:
+                        prefetched_context.cancel()
+                    if on_token is not None:
+                        on_token(cached_answer)
+                    return cached_answer
             except Exception as e:
-                print(f"ERROR: [Stage 2] RAG retrieval failed: {e}")
-                context_docs = []
+                print(f"ERROR: [Stage 1.6] Answer cache lookup failed: {e}")
+
+        context_docs = []
+        if full_query_text:
+            if prefetched_context is not None and not query_image:
+                if prefetched_context.cancel():
+                    # Job suy đoán chưa kịp chạy: truy xuất trực tiếp thay vì chờ trong hàng đợi
+                    print("DEBUG: [Stage 2] Speculative retrieval not started yet, retrieving inline")
+                    context_docs = retrieve_context(full_query_text, resources)
+                else:
+                    print("DEBUG: [Stage 2] Using speculative retrieval started during intent classification")
+                    try:
+                        context_docs = prefetched_context.result(timeout=SPECULATIVE_RETRIEVAL_WAIT_SECONDS)
+                    except Exception as e:
+                        print(f"ERROR: [Stage 2] Speculative retrieval failed or timed out: {e}")
+                        context_docs = retrieve_context(full_query_text, resources)
+            else:
+                context_docs = retrieve_context(full_query_text, resources)
+
+        if context_docs and resources.get("context_packer") is not None:
+            packed = resources["context_packer"].run(documents=context_docs)
+            context_docs = packed["documents"]
+            print(f"DEBUG: [Stage 2.5] Context packed: {packed['stats']}")
 
         print("DEBUG: [Stage 3] Building final prompt...")
         
@@ -847,17 +1142,29 @@ def problem_solving_engine(
             
         print("DEBUG: [Stage 4] Calling Gemini for final answer...")
         try:
-            final_result = resources["generator"].run(prompt_parts=final_prompt_parts)
-            informer_answer = final_result["replies"][0]
+            informer_answer = generate_reply(resources, final_prompt_parts, on_token=on_token, agent="informer")
             print(f"DEBUG: [Stage 4] Got answer, length: {len(informer_answer)} chars")
+        except GeminiCallError as e:
+            print(f"ERROR: [Stage 4] Gemini call failed: {e.error}")
+            return str(e)
         except Exception as e:
             print(f"ERROR: [Stage 4] Gemini call failed: {e}")
             return f"Xin lỗi, tôi không thể xử lý câu hỏi này lúc này. Lỗi: {str(e)}"
 
         try:
-            print("DEBUG: [Stage 5] Starting verification...")
             verification_query = full_query_text if full_query_text else "Phân tích bài toán trong hình ảnh"
-            verification = verifier_agent(verification_query, informer_answer, resources)
+            if on_verification is not None:
+                print("DEBUG: [Stage 5] Submitting verification to background worker...")
+                on_verification(get_background_executor().submit(
+                    verify_and_cache, verification_query, informer_answer, resources, cache_query, cache_embedding
+                ))
+                return informer_answer
+
+            print("DEBUG: [Stage 5] Starting verification...")
+            # Học sinh đang chờ kết quả kiểm tra: dùng làn INTERACTIVE thay vì làn nền của verifier
+            verification = verify_and_cache(
+                verification_query, informer_answer, resources, cache_query, cache_embedding, priority=INTERACTIVE
+            )
             print(f"DEBUG: [Stage 5] Verification result: {verification}")
             
             if verification.get("is_correct", True):
@@ -876,7 +1183,38 @@ def problem_solving_engine(
         return f"Xin lỗi, đã có lỗi nghiêm trọng khi xử lý yêu cầu: {str(e)}"
 
 
-def tutor_agent_response(user_input: str, intent: str, conversation_history_str: str, resources: Dict, supabase: Client, user_id: str, display_name: str) -> str:
+def annotate_with_correction(answer: str, verification: Dict) -> str:
+    """Gắn ghi chú của verifier vào cuối lời giải đã hiển thị."""
+    correction = verification.get("correction_suggestion", "")
+    return f"{answer}\n\n🔍 **Lưu ý sau khi kiểm tra lại:** Tôi thấy lời giải trên có một chút chưa chính xác. {correction}"
+
+def resolve_pending_verifications(timeout: float = 0) -> bool:
+    """
+    Áp kết quả của các verifier chạy nền vào tin nhắn tương ứng trong session_state.
+    Trả về True nếu có tin nhắn được chú thích lại.
+    """
+    pending = st.session_state.get("pending_verifications", {})
+    messages = st.session_state.get("messages", [])
+    changed = False
+
+    for msg_index, future in list(pending.items()):
+        try:
+            verification = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            continue
+        except Exception as e:
+            print(f"ERROR: [Stage 5] Background verification failed: {e}")
+            verification = {"is_correct": True, "correction_suggestion": ""}
+
+        del pending[msg_index]
+        print(f"DEBUG: [Stage 5] Background verification result for message {msg_index}: {verification}")
+        if not verification.get("is_correct", True) and msg_index < len(messages):
+            messages[msg_index]["content"] = annotate_with_correction(messages[msg_index]["content"], verification)
+            changed = True
+
+    return changed
+
+def tutor_agent_response(user_input: str, intent: str, conversation_history_str: str, resources: Dict, supabase: Client, user_id: str, display_name: str, on_token: Optional[Callable[[str], None]] = None) -> str:
     """
     Agent chính, bây giờ CHỈ xử lý các intent giao tiếp.
     Các câu hỏi toán học đã được xử lý bởi problem_solving_engine.
@@ -891,12 +1229,13 @@ def tutor_agent_response(user_input: str, intent: str, conversation_history_str:
         prompt_builder = resources["support_prompt_builder"]
     elif intent == "request_for_practice":
         print("DEBUG: Tutor Agent is triggering the Practice Flow.")
-        insights = insight_agent(conversation_history_str, resources)
+        # Học sinh đang chờ bài tập nên phân tích chạy ở làn interactive, không phải làn proactive mặc định
+        insights = insight_agent(conversation_history_str, resources, priority=INTERACTIVE)
         if insights and insights.get("misunderstood_concepts"):
             weakness = insights["misunderstood_concepts"][0]
-            return practice_agent(weakness, resources)
+            return practice_agent(weakness, resources, on_token=on_token)
         else:
-            return practice_agent("các chủ đề toán lớp 9 tổng quát", resources)
+            return practice_agent("các chủ đề toán lớp 9 tổng quát", resources, on_token=on_token)
     else: 
         prompt_builder = resources["off_topic_prompt_builder"]
         
@@ -906,15 +1245,21 @@ def tutor_agent_response(user_input: str, intent: str, conversation_history_str:
             conversation_history=conversation_history_str
         )["prompt"]
         
-        result = resources["generator"].run(prompt_parts=[prompt_text])
-        return result["replies"][0]
+        return generate_reply(resources, [prompt_text], on_token=on_token, agent="tutor")
+    except GeminiCallError as e:
+        print(f"ERROR: Could not generate response for intent '{intent}': {e.error}")
+        return str(e)
     except Exception as e:
         print(f"ERROR: Could not generate response for intent '{intent}': {e}")
         return "Rất xin lỗi, tôi đang gặp một chút sự cố."
 
-def render_chat_message(content: str, is_user: bool, key: str, image: bytes = None):
-    """Render tin nhắn chat, có thể kèm ảnh."""
+def render_chat_message(content: str, is_user: bool, key: str, image: bytes = None, placeholder=None):
+    """
+    Render tin nhắn chat, có thể kèm ảnh.
+    Nếu có `placeholder` (st.empty()), nội dung được ghi đè vào đó để cập nhật dần khi streaming.
+    """
     css_class = "user-message" if is_user else "bot-message"
+    target = placeholder if placeholder is not None else st
     
     if image:
         st.image(image, width=250)
@@ -954,7 +1299,7 @@ def render_chat_message(content: str, is_user: bool, key: str, image: bytes = No
         final_content = '\n\n'.join(formatted_paragraphs)
         
         # Sử dụng markdown để render với format đúng
-        st.markdown(f'<div class="{css_class}">{final_content}</div>', unsafe_allow_html=True)
+        target.markdown(f'<div class="{css_class}">{final_content}</div>', unsafe_allow_html=True)
 
 def should_trigger_proactive_practice(conversation_history: List[Dict[str, str]]) -> bool:
     """
@@ -1178,6 +1523,9 @@ def create_chat_input_interface():
 def main():
     """Hàm chính của ứng dụng"""
     
+    # Bắt đầu nạp model trong nền ngay từ đầu, trang đăng nhập không phải chờ
+    get_model_registry()
+
     # Khởi tạo Supabase
     supabase = init_supabase_client()
     
@@ -1214,6 +1562,11 @@ def main():
     if "processed_audio_ids" not in st.session_state:
         st.session_state.processed_audio_ids = set()
 
+    # Verifier chạy nền của lượt trước: {chỉ số tin nhắn: Future}
+    if "pending_verifications" not in st.session_state:
+        st.session_state.pending_verifications = {}
+    resolve_pending_verifications()
+
     # Container để chứa các tin nhắn chat
     chat_placeholder = st.container()
     with chat_placeholder:
@@ -1235,8 +1588,15 @@ def main():
         
         # Chỉ xử lý nếu audio này chưa được xử lý
         if audio_id not in st.session_state.processed_audio_ids:
-            with st.spinner("🎧 Đang xử lý giọng nói..."):
-                transcribed_text = transcribe_audio(audio_input, resources["whisper_model"])
+            models = resources["models"]
+            spinner_text = "🎧 Đang xử lý giọng nói..." if models.is_ready("asr_pool") else "🎧 Đang tải mô hình giọng nói (lần đầu)..."
+            with st.spinner(spinner_text):
+                try:
+                    asr_pool = models.get("asr_pool")
+                except RuntimeError as e:
+                    st.error(f"Lỗi khi tải mô hình giọng nói: {e}")
+                    asr_pool = None
+                transcribed_text = transcribe_audio(audio_input, asr_pool) if asr_pool else ""
                 if transcribed_text and transcribed_text.strip() and len(transcribed_text.strip()) > 1:
                     final_user_text = transcribed_text
                     st.success(f"✅ Đã nhận diện: {transcribed_text}")
@@ -1269,20 +1629,43 @@ def main():
              render_chat_message(final_user_text, is_user=True, image=final_image_data, key=f"user_{len(st.session_state.messages)}")
 
         history_str_for_llm = "\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in st.session_state.messages[-10:] if msg['content']])
+
+        # Truy xuất RAG không phụ thuộc intent: chạy suy đoán song song với lời gọi phân loại
+        speculative_retrieval = None
+        if final_user_text and not final_image_data:
+            speculative_retrieval = get_retrieval_executor().submit(retrieve_context, final_user_text, resources)
+
         detected_intent = classify_intent(history_str_for_llm, resources)
         st.session_state.messages[-1]["intent"] = detected_intent
         
         with chat_placeholder:
             typing_indicator_placeholder = show_typing_indicator()
+            streaming_placeholder = st.empty()
+
+        bot_key = f"bot_{len(st.session_state.messages) + 1}"
+
+        def on_token(partial_text: str):
+            # Ẩn indicator ngay khi có token đầu tiên và hiển thị dần câu trả lời
+            typing_indicator_placeholder.empty()
+            render_chat_message(partial_text, is_user=False, key=bot_key, placeholder=streaming_placeholder)
+
+        verification_futures = []
 
         if final_image_data or detected_intent == "math_question":
             bot_response = problem_solving_engine(
                 query_text=final_user_text,
                 query_image=final_image_data,
                 conversation_history_str=history_str_for_llm,
-                resources=resources
+                resources=resources,
+                on_token=on_token,
+                on_verification=verification_futures.append if BACKGROUND_VERIFICATION else None,
+                prefetched_context=speculative_retrieval,
+                has_prior_turns=any(msg["role"] == "user" for msg in st.session_state.messages[:-1])
             )
         else:
+            if speculative_retrieval is not None:
+                # Không phải câu hỏi toán: bỏ kết quả truy xuất suy đoán
+                speculative_retrieval.cancel()
             bot_response = tutor_agent_response(
                 user_input=final_user_text, 
                 intent=detected_intent,
@@ -1290,14 +1673,18 @@ def main():
                 resources=resources,
                 supabase=supabase,
                 user_id=user_id,
-                display_name=display_name
+                display_name=display_name,
+                on_token=on_token
             )
         
         typing_indicator_placeholder.empty()
 
         st.session_state.messages.append({"role": "assistant", "content": bot_response, "intent": detected_intent, "image": None})
-        with chat_placeholder:
-            render_chat_message(bot_response, is_user=False, key=f"bot_{len(st.session_state.messages)}")
+        # Ghi đè bản stream bằng câu trả lời cuối cùng (có thể đã được verifier chỉnh sửa)
+        render_chat_message(bot_response, is_user=False, key=bot_key, placeholder=streaming_placeholder)
+
+        for future in verification_futures:
+            st.session_state.pending_verifications[len(st.session_state.messages) - 1] = future
 
         if should_trigger_proactive_practice(st.session_state.messages):
     
@@ -1311,7 +1698,7 @@ def main():
                 
                 # Gọi Insight Agent
                 print("DEBUG: [Proactive Flow] Gọi Insight Agent...")
-                insights = insight_agent(history_str_for_insight, resources)
+                insights = insight_agent(history_str_for_insight, resources, priority=PROACTIVE)
                 print(f"DEBUG: [Proactive Flow] Insight Agent trả về: {insights}")
                 
                 if insights and isinstance(insights, dict) and insights.get("misunderstood_concepts"):
@@ -1341,7 +1728,7 @@ def main():
                     st.toast("✅ Đã phân tích và cập nhật hồ sơ học tập!", icon="🧠")
                     print(f"DEBUG: [Proactive Flow] Phát hiện điểm yếu: '{last_weakness}'. Gọi Practice Agent...")
                     
-                    practice_response = practice_agent(last_weakness, resources)
+                    practice_response = practice_agent(last_weakness, resources, priority=PROACTIVE)
                     
                     proactive_msg = f"💡 **Phân tích nhanh:** Dựa trên các câu hỏi vừa rồi, tôi nhận thấy bạn có thể cần luyện tập thêm về chủ đề **'{last_weakness}'**. Đây là một số gợi ý cho bạn:\n\n{practice_response}"
                     
@@ -1359,6 +1746,12 @@ def main():
                 print(f"ERROR: [Proactive Flow] Đã xảy ra lỗi: {str(e)}")
                 proactive_typing_placeholder.empty()
 
+        # Chờ verifier nền (đã chạy song song với luồng chủ động) trước khi rerun
+        if st.session_state.pending_verifications:
+            with chat_placeholder:
+                with st.spinner("🔍 Đang kiểm tra lại lời giải..."):
+                    resolve_pending_verifications(timeout=VERIFICATION_WAIT_SECONDS)
+
         # Rerun để cập nhật giao diện
         st.rerun()
 
@@ -1370,7 +1763,7 @@ def main():
         if st.button("Đăng xuất", use_container_width=True):
             supabase.auth.sign_out()
             # Xóa các session state liên quan đến user
-            keys_to_delete = ["user", "messages", "processed_audio_ids"]
+            keys_to_delete = ["user", "messages", "processed_audio_ids", "pending_verifications"]
             for key in keys_to_delete:
                 if key in st.session_state:
                     del st.session_state[key]
@@ -1382,7 +1775,35 @@ def main():
             st.session_state.messages = []
             # Cũng xóa audio đã xử lý để có thể ghi âm lại
             st.session_state.processed_audio_ids = set()
+            st.session_state.pending_verifications = {}
             st.rerun()
 
+        with st.expander("⚙️ Thống kê hệ thống"):
+            models = resources["models"]
+            st.caption("Trạng thái model")
+            st.json(models.statuses())
+            st.caption("Answer cache")
+            st.json(resources["answer_cache"].stats())
+            st.caption("Image preprocessing cache")
+            st.json(resources["image_preprocessor"].stats())
+            st.caption("OCR cache")
+            st.json(resources["ocr_cache"].stats())
+            if resources["symbolic_solver"] is not None:
+                st.caption("Symbolic fast path")
+                st.json(resources["symbolic_solver"].stats())
+            if models.is_ready("text_embedder"):
+                text_embedder = models.get("text_embedder")
+                st.caption("Query embedding cache")
+                st.json(text_embedder.stats())
+                st.caption("Embedding batcher")
+                st.json(text_embedder.embedder.stats())
+            st.caption("Gemini client")
+            st.json(resources["generator"].client.stats())
+            if models.is_ready("asr_pool"):
+                st.caption("ASR worker pool")
+                st.json(models.get("asr_pool").stats())
+            st.caption("Context packer")
+            st.json(resources["context_packer"].totals())
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,203 @@
+import io
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional
+
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+# Bỏ các đoạn im lặng dài hơn ngưỡng này trước khi giải mã
+VAD_PARAMETERS = {"min_silence_duration_ms": 500}
+
+_batched_pipelines: Dict[int, BatchedInferencePipeline] = {}
+_batched_pipelines_lock = threading.Lock()
+
+
+def _get_batched_pipeline(whisper_model: WhisperModel) -> BatchedInferencePipeline:
+    """Mỗi WhisperModel chỉ tạo một BatchedInferencePipeline."""
+    with _batched_pipelines_lock:
+        pipeline = _batched_pipelines.get(id(whisper_model))
+        if pipeline is None:
+            pipeline = BatchedInferencePipeline(model=whisper_model)
+            _batched_pipelines[id(whisper_model)] = pipeline
+        return pipeline
+
+
+def transcribe_bytes(
+    audio_bytes: bytes,
+    whisper_model: WhisperModel,
+    language: str = "vi",
+    beam_size: int = 5,
+    vad_filter: bool = True,
+    batched: bool = False,
+    batch_size: int = 8,
+) -> Dict[str, Any]:
+    """
+    Nhận dạng giọng nói trực tiếp từ bytes trong bộ nhớ (không ghi file tạm).
+    VAD bỏ qua khoảng lặng; `batched` dùng BatchedInferencePipeline để giải mã song song các đoạn.
+    Trả về văn bản kèm thời lượng audio, thời gian xử lý và real-time factor (RTF).
+    """
+    start = time.perf_counter()
+    audio = io.BytesIO(audio_bytes)
+
+    if batched:
+        segments, info = _get_batched_pipeline(whisper_model).transcribe(
+            audio, language=language, beam_size=beam_size, batch_size=batch_size,
+            vad_filter=vad_filter, vad_parameters=VAD_PARAMETERS if vad_filter else None,
+        )
+    else:
+        segments, info = whisper_model.transcribe(
+            audio, language=language, beam_size=beam_size,
+            vad_filter=vad_filter, vad_parameters=VAD_PARAMETERS if vad_filter else None,
+        )
+
+    # segments là generator: việc giải mã thực sự diễn ra khi duyệt
+    text = " ".join(segment.text for segment in segments).strip()
+    elapsed = time.perf_counter() - start
+    duration = float(getattr(info, "duration", 0.0) or 0.0)
+
+    return {
+        "text": text,
+        "language": info.language,
+        "language_probability": info.language_probability,
+        "duration": duration,
+        "duration_after_vad": float(getattr(info, "duration_after_vad", duration) or 0.0),
+        "elapsed": elapsed,
+        "rtf": elapsed / duration if duration else 0.0,
+    }
+
+
+class TranscriptionQueueFull(RuntimeError):
+    """Hàng đợi nhận dạng giọng nói đã đầy, người gọi nên báo hệ thống bận thay vì chờ."""
+
+
+# Model Whisper riêng của mỗi tiến trình worker, được nạp một lần trong initializer
+_worker_model: Optional[WhisperModel] = None
+
+
+def _init_worker(model_size: str, compute_type: str, cpu_threads: int):
+    global _worker_model
+    _worker_model = WhisperModel(model_size, device="cpu", compute_type=compute_type, cpu_threads=cpu_threads)
+
+
+def _worker_ready() -> int:
+    return os.getpid()
+
+
+def _transcribe_in_worker(audio_bytes: bytes, options: Dict[str, Any]) -> Dict[str, Any]:
+    result = transcribe_bytes(audio_bytes, _worker_model, **options)
+    result["worker_pid"] = os.getpid()
+    return result
+
+
+class TranscriptionPool:
+    """
+    Pool tiến trình nhận dạng giọng nói, mỗi worker giữ một WhisperModel với `cpu_threads` cố định.
+    Suy luận CTranslate2 chạy ngoài tiến trình Streamlit nên một bản ghi dài không chặn các phiên khác,
+    và thông lượng tăng theo số worker thay vì tranh chấp một model dùng chung.
+    Hàng đợi có giới hạn: khi đã có `workers + max_queue` job chưa xong, `submit` ném TranscriptionQueueFull.
+    """
+
+    def __init__(
+        self,
+        model_size: str = "small",
+        compute_type: str = "int8",
+        workers: int = 2,
+        cpu_threads: int = 2,
+        max_queue: int = 8,
+        timeout_seconds: float = 120,
+    ):
+        self.workers = workers
+        self.cpu_threads = cpu_threads
+        self.max_queue = max_queue
+        self.timeout_seconds = timeout_seconds
+        # spawn thay vì fork: tiến trình Streamlit đã có nhiều thread (embedder, verifier...)
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_size, compute_type, cpu_threads),
+        )
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stats = {
+            "submitted": 0, "completed": 0, "failed": 0, "timeouts": 0, "rejected": 0,
+            "audio_seconds": 0.0, "busy_seconds": 0.0,
+        }
+
+    def warm_up(self) -> List[int]:
+        """Khởi động đủ worker (mỗi worker nạp model trong initializer) và trả về danh sách pid."""
+        futures = [self._executor.submit(_worker_ready) for _ in range(self.workers)]
+        return sorted({future.result() for future in futures})
+
+    def submit(self, audio_bytes: bytes, **options: Any) -> Future:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise TranscriptionQueueFull(f"Đã có {self.workers + self.max_queue} yêu cầu giọng nói đang chờ xử lý")
+
+        with self._lock:
+            self._pending += 1
+            self._stats["submitted"] += 1
+        try:
+            future = self._executor.submit(_transcribe_in_worker, audio_bytes, options)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._on_done)
+        return future
+
+    def transcribe(self, audio_bytes: bytes, timeout: Optional[float] = None, **options: Any) -> Dict[str, Any]:
+        """
+        Gửi một job và chờ kết quả tối đa `timeout` giây (mặc định `timeout_seconds`).
+        Job đã chạy thì không dừng được giữa chừng; slot hàng đợi chỉ được trả khi worker thực sự xong.
+        """
+        future = self.submit(audio_bytes, **options)
+        try:
+            return future.result(timeout=timeout or self.timeout_seconds)
+        except FutureTimeoutError:
+            future.cancel()
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise TimeoutError(f"Nhận dạng giọng nói quá {timeout or self.timeout_seconds}s")
+
+    def queue_depth(self) -> int:
+        """Số job đang chờ worker rảnh (không tính các job đang chạy)."""
+        with self._lock:
+            return max(self._pending - self.workers, 0)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                **self._stats,
+                "workers": self.workers,
+                "cpu_threads": self.cpu_threads,
+                "in_flight": self._pending,
+                "queue_depth": max(self._pending - self.workers, 0),
+                "max_queue": self.max_queue,
+                "avg_rtf": self._stats["busy_seconds"] / self._stats["audio_seconds"] if self._stats["audio_seconds"] else 0.0,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _on_done(self, future: Future):
+        with self._lock:
+            if future.cancelled():
+                pass
+            elif future.exception() is not None:
+                self._stats["failed"] += 1
+            else:
+                result = future.result()
+                self._stats["completed"] += 1
+                self._stats["audio_seconds"] += result["duration"]
+                self._stats["busy_seconds"] += result["elapsed"]
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
@@ -0,0 +1,359 @@
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+
+from haystack import component
+
+
+def normalize_query(text: str) -> str:
+    """Chuẩn hóa câu hỏi để làm khóa cache: NFC, chữ thường, gộp khoảng trắng, bỏ dấu câu cuối."""
+    text = unicodedata.normalize("NFC", text).lower()
+    text = " ".join(text.split())
+    return text.rstrip(" .?!")
+
+
+def normalize_embedding_key(text: str) -> str:
+    """Khóa cho cache embedding: NFC và gộp khoảng trắng (giữ nguyên hoa/thường vì ảnh hưởng tới embedding)."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+# Từ đệm/xưng hô không đổi nội dung câu hỏi: bỏ khỏi chữ ký để các cách hỏi khác nhau vẫn dùng chung lời giải
+SIGNATURE_STOPWORDS = {
+    "ạ", "à", "ơi", "nhé", "nha", "hãy", "giúp", "giùm", "dùm", "em", "mình", "tôi", "tớ", "bạn",
+    "thầy", "cô", "anh", "chị", "cho", "với", "làm", "ơn", "muốn", "cần", "hỏi", "bài", "này", "đi", "vậy",
+}
+
+
+def _math_tokens(text: str) -> List[str]:
+    return re.findall(r"\d+(?:[.,]\d+)?|[=<>≤≥≠+\-*/^²³√]", text)
+
+
+def math_signature(text: str) -> List[str]:
+    """
+    Dãy số và ký hiệu toán trong câu hỏi, kèm tập các từ nội dung (đã bỏ từ đệm).
+    Hai câu "x + 5 = 10" và "x + 6 = 10" có embedding gần như trùng nhau nhưng đáp án khác; "diện tích hình vuông
+    cạnh 5" và "chu vi hình vuông cạnh 5" có cùng các số nhưng hỏi đại lượng khác. Cache ngữ nghĩa chỉ chấp nhận
+    khi chữ ký này khớp.
+    """
+    words = sorted(set(re.findall(r"[^\W\d_]+", text.lower())) - SIGNATURE_STOPWORDS)
+    return _math_tokens(text) + words
+
+
+class SemanticAnswerCache:
+    """
+    Cache lời giải đã được kiểm chứng, lưu trên đĩa (SQLite).
+    Tra cứu theo câu hỏi đã chuẩn hóa, sau đó theo cosine của embedding với ngưỡng tương đồng.
+    Loại bỏ theo TTL và LRU (last_access) khi vượt quá số mục tối đa.
+    """
+
+    def __init__(
+        self,
+        path: str = "answer_cache.sqlite3",
+        similarity_threshold: float = 0.95,
+        max_entries: int = 2000,
+        ttl_seconds: float = 7 * 24 * 3600,
+    ):
+        self.path = path
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                query TEXT NOT NULL,
+                embedding BLOB,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+        self._counters = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        with self._lock:
+            self._evict()
+            self._reload_index()
+
+    def lookup(self, query: str, embedding: Optional[Sequence[float]] = None) -> Optional[str]:
+        """Trả về lời giải đã cache hoặc None."""
+        normalized = normalize_query(query)
+        key = _key(normalized)
+        now = time.time()
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT answer, created_at FROM answers WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[1] <= self.ttl_seconds:
+                self._touch(key, now)
+                self._counters["exact_hits"] += 1
+                return row[0]
+
+            # Câu hỏi không có số/ký hiệu toán nào: không đủ căn cứ để coi hai câu là cùng một bài
+            if embedding is not None and len(self._keys) and _math_tokens(normalized):
+                query_vector = _normalize(np.asarray(embedding, dtype=np.float32))
+                similarities = self._embeddings @ query_vector
+                signature = math_signature(normalized)
+                for idx in np.argsort(similarities)[::-1]:
+                    if similarities[idx] < self.similarity_threshold:
+                        break
+                    if self._signatures[idx] != signature:
+                        continue
+                    row = self._conn.execute(
+                        "SELECT answer, created_at FROM answers WHERE key = ?", (self._keys[idx],)
+                    ).fetchone()
+                    if row and now - row[1] <= self.ttl_seconds:
+                        self._touch(self._keys[idx], now)
+                        self._counters["semantic_hits"] += 1
+                        return row[0]
+
+            self._counters["misses"] += 1
+            return None
+
+    def store(self, query: str, embedding: Optional[Sequence[float]], answer: str):
+        """Lưu một lời giải đã được verifier xác nhận là đúng."""
+        normalized = normalize_query(query)
+        now = time.time()
+        blob = np.asarray(embedding, dtype=np.float32).tobytes() if embedding is not None else None
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers (key, query, embedding, answer, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (_key(normalized), normalized, blob, answer, now, now),
+            )
+            self._conn.commit()
+            self._counters["stores"] += 1
+            self._evict()
+            self._reload_index()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            hits = self._counters["exact_hits"] + self._counters["semantic_hits"]
+            lookups = hits + self._counters["misses"]
+            return {
+                **self._counters,
+                "entries": len(self._keys),
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+    def _touch(self, key: str, now: float):
+        self._conn.execute("UPDATE answers SET last_access = ? WHERE key = ?", (now, key))
+        self._conn.commit()
+
+    def _evict(self):
+        cursor = self._conn.execute("DELETE FROM answers WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        evicted = cursor.rowcount
+        count = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        if count > self.max_entries:
+            cursor = self._conn.execute(
+                "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            evicted += cursor.rowcount
+        self._conn.commit()
+        self._counters["evictions"] += max(evicted, 0)
+
+    def _reload_index(self):
+        rows = self._conn.execute("SELECT key, query, embedding FROM answers WHERE embedding IS NOT NULL").fetchall()
+        self._keys = [row[0] for row in rows]
+        self._signatures = [math_signature(row[1]) for row in rows]
+        if rows:
+            self._embeddings = np.stack([_normalize(np.frombuffer(row[2], dtype=np.float32)) for row in rows])
+        else:
+            self._embeddings = np.zeros((0, 0), dtype=np.float32)
+
+
+class OcrCache:
+    """
+    Cache kết quả OCR lưu trên đĩa (SQLite), khóa chính là hash nội dung (SHA-256) của ảnh.
+    Ảnh tải lại y hệt được dùng lại ngay. Ảnh gần giống (lưu lại/nén lại/thu nhỏ lại) được so theo dấu vân ảnh
+    (`ImagePreprocessor.fingerprint`, lưới xám 128×128): lọc nhanh ứng viên trên lưới thô 16×16 giữ trong bộ nhớ
+    (sai lệch trung bình <= `max_mean_diff`), rồi xác nhận trên lưới đầy đủ: mọi điểm ảnh lệch <= `max_pixel_diff`.
+    Hai phiếu cùng bố cục chỉ khác vài chữ số lệch cục bộ vài chục mức xám nên không bị nhận nhầm;
+    ảnh cắt lại không khớp và phải OCR lại. Loại bỏ theo LRU (last_access) khi vượt quá số mục tối đa.
+    """
+
+    def __init__(
+        self, path: str = "ocr_cache.sqlite3", max_mean_diff: float = 2.0, max_pixel_diff: int = 6,
+        max_candidates: int = 3, max_entries: int = 5000,
+    ):
+        self.path = path
+        self.max_mean_diff = max_mean_diff
+        self.max_pixel_diff = max_pixel_diff
+        self.max_candidates = max_candidates
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ocr_texts (
+                digest TEXT PRIMARY KEY,
+                fingerprint BLOB NOT NULL,
+                text TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+        self._counters = {"exact_hits": 0, "near_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        with self._lock:
+            self._evict()
+            self._reload_index()
+
+    def lookup(self, digest: str, fingerprint: bytes) -> Optional[str]:
+        """Trả về văn bản OCR của ảnh trùng nội dung, hoặc của ảnh có dấu vân khớp; None nếu không có."""
+        with self._lock:
+            row = self._conn.execute("SELECT text FROM ocr_texts WHERE digest = ?", (digest,)).fetchone()
+            if row:
+                self._touch(digest)
+                self._counters["exact_hits"] += 1
+                return row[0]
+
+            if len(self._coarse):
+                pixels = _fingerprint_pixels(fingerprint)
+                coarse = _coarse_grid(pixels)
+                if coarse.shape == self._coarse.shape[1:]:
+                    distances = np.abs(self._coarse - coarse).mean(axis=(1, 2))
+                    candidates = np.flatnonzero(distances <= self.max_mean_diff)
+                    for index in candidates[np.argsort(distances[candidates])][: self.max_candidates]:
+                        key = self._keys[int(index)]
+                        row = self._conn.execute(
+                            "SELECT fingerprint, text FROM ocr_texts WHERE digest = ?", (key,)
+                        ).fetchone()
+                        if row is None:
+                            continue
+                        stored = _fingerprint_pixels(row[0])
+                        if stored.shape == pixels.shape and np.abs(stored - pixels).max() <= self.max_pixel_diff:
+                            self._touch(key)
+                            self._counters["near_hits"] += 1
+                            return row[1]
+
+            self._counters["misses"] += 1
+            return None
+
+    def store(self, digest: str, fingerprint: bytes, text: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ocr_texts (digest, fingerprint, text, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (digest, sqlite3.Binary(fingerprint), text, now, now),
+            )
+            self._conn.commit()
+            self._counters["stores"] += 1
+            self._evict()
+            self._reload_index()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            hits = self._counters["exact_hits"] + self._counters["near_hits"]
+            lookups = hits + self._counters["misses"]
+            return {
+                **self._counters,
+                "entries": len(self._keys),
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+    def _touch(self, digest: str):
+        self._conn.execute("UPDATE ocr_texts SET last_access = ? WHERE digest = ?", (time.time(), digest))
+        self._conn.commit()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM ocr_texts").fetchone()[0]
+        if count > self.max_entries:
+            cursor = self._conn.execute(
+                "DELETE FROM ocr_texts WHERE digest IN (SELECT digest FROM ocr_texts ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            self._conn.commit()
+            self._counters["evictions"] += max(cursor.rowcount, 0)
+
+    def _reload_index(self):
+        # Chỉ giữ lưới thô trong bộ nhớ (~1 KB/ảnh); lưới đầy đủ đọc từ SQLite khi cần xác nhận
+        rows = self._conn.execute("SELECT digest, fingerprint FROM ocr_texts").fetchall()
+        self._keys = [row[0] for row in rows]
+        grids = [_coarse_grid(_fingerprint_pixels(row[1])) for row in rows]
+        self._coarse = np.stack(grids) if grids else np.zeros((0, 0, 0), dtype=np.float32)
+
+
+@component
+class CachedTextEmbedder:
+    """
+    Cache LRU dùng chung toàn tiến trình đặt trước SentenceTransformersTextEmbedder.
+    Cùng interface `run(text=...)` nên các nơi dùng (RAG, intent, answer cache...) nhận lại
+    đúng vector đã tính thay vì chạy lại forward pass trên CPU.
+    """
+
+    def __init__(self, embedder: Any, max_size: int = 4096):
+        self.embedder = embedder
+        self.max_size = max_size
+        self._cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @component.output_types(embedding=List[float])
+    def run(self, text: str):
+        key = normalize_embedding_key(text)
+        with self._lock:
+            embedding = self._cache.get(key)
+            if embedding is not None:
+                self._cache.move_to_end(key)
+                self._hits += 1
+                return {"embedding": embedding}
+            self._misses += 1
+
+        embedding = self.embedder.run(text=text)["embedding"]
+        with self._lock:
+            self._cache[key] = embedding
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return {"embedding": embedding}
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "entries": len(self._cache),
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+            }
+
+
+def _key(normalized_query: str) -> str:
+    return hashlib.sha256(normalized_query.encode("utf-8")).hexdigest()
+
+
+def _normalize(vector: np.ndarray) -> np.ndarray:
+    return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+
+def _fingerprint_pixels(fingerprint: bytes) -> np.ndarray:
+    """Lưới xám vuông (int16) từ dấu vân ảnh dạng bytes."""
+    pixels = np.frombuffer(fingerprint, dtype=np.uint8)
+    side = int(round(np.sqrt(len(pixels))))
+    return pixels[: side * side].reshape(side, side).astype(np.int16)
+
+
+def _coarse_grid(pixels: np.ndarray, cells: int = 16) -> np.ndarray:
+    """Thu lưới xám về `cells`×`cells` ô bằng trung bình từng khối (dùng để lọc nhanh ứng viên)."""
+    block = max(pixels.shape[0] // cells, 1)
+    side = block * cells
+    if pixels.shape[0] < side:
+        return pixels.astype(np.float32)
+    return pixels[:side, :side].reshape(cells, block, cells, block).mean(axis=(1, 3)).astype(np.float32)
@@ -0,0 +1,389 @@
+"""
+Định dạng corpus trên đĩa cho học liệu đã embedding.
+
+    corpus/
+        embeddings.npy   ma trận embedding liên tục (float32 hoặc float16), đã chuẩn hóa L2, mở bằng np.memmap
+        documents.json   metadata dạng cột: ids, contents, metas
+
+Chuyển đổi từ file pickle cũ:
+    python corpus_utils.py export embedded_documents.pkl corpus
+
+Tạo corpus từ sách giáo khoa dạng Markdown (chỉ embedding lại các đoạn có nội dung thay đổi):
+    python corpus_utils.py ingest math.txt corpus --batch-size 64
+
+Xây chỉ mục ANN (IVF) và đo recall so với tìm kiếm chính xác:
+    python corpus_utils.py build-index corpus --n-lists 64 --nprobe 8
+    python corpus_utils.py recall-report corpus --k 10 --nprobe 1 2 4 8 16
+"""
+import os
+import re
+import json
+import time
+import pickle
+import hashlib
+import argparse
+import numpy as np
+from typing import Any, Dict, List, Optional
+
+from haystack import Document
+
+EMBEDDINGS_FILE = "embeddings.npy"
+DOCUMENTS_FILE = "documents.json"
+ANN_INDEX_FILE = "ivf_index.npz"
+FORMAT_VERSION = 1
+EMBEDDING_MODEL = "bkai-foundation-models/vietnamese-bi-encoder"
+
+HEADING_PATTERN = re.compile(r"^(#{1,3})\s+(.*?)\s*$")
+BOOK_PATTERN = re.compile(r"Tập\s+(\d+)")
+CHAPTER_PATTERN = re.compile(r"^CHƯƠNG\s+([IVXLC]+)\s*:\s*(.*)$")
+CHAPTER_REVIEW_PATTERN = re.compile(r"^BÀI TẬP CUỐI CHƯƠNG\s+([IVXLC]+)", re.IGNORECASE)
+SECTION_PATTERN = re.compile(r"^(§\d+)\.\s*(.*)$")
+TOC_ROW_PATTERN = re.compile(r"^\|(.*?)\|(.*?)\|(.*?)\|\s*$")
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Chuẩn hóa L2 từng dòng, trả về float32 liên tục."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return np.ascontiguousarray(matrix / np.maximum(norms, 1e-12))
+
+
+class Corpus:
+    """
+    Corpus dạng cột: một ma trận embedding (n, d) và các cột ids/contents/metas.
+    Các Document của Haystack chỉ được tạo khi cần.
+    `normalized`: các dòng embedding đã được chuẩn hóa L2 (retriever dùng trực tiếp, không cần sao chép).
+    """
+
+    def __init__(self, embeddings: np.ndarray, ids: List[str], contents: List[str], metas: List[Dict[str, Any]], normalized: bool = False):
+        if not (len(embeddings) == len(ids) == len(contents) == len(metas)):
+            raise ValueError("Các cột của corpus không cùng độ dài")
+        self.embeddings = embeddings
+        self.ids = ids
+        self.contents = contents
+        self.metas = metas
+        self.normalized = normalized
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_documents(cls, documents: List[Document]) -> "Corpus":
+        embeddings = normalize_rows([doc.embedding for doc in documents])
+        return cls(
+            embeddings=embeddings,
+            ids=[doc.id for doc in documents],
+            contents=[doc.content or "" for doc in documents],
+            metas=[dict(doc.meta or {}) for doc in documents],
+            normalized=True,
+        )
+
+    def fingerprint(self) -> str:
+        """Hash của danh sách id theo thứ tự dòng; đổi khi corpus được ingest/export lại với nội dung khác."""
+        return hashlib.sha256("\n".join(self.ids).encode("utf-8")).hexdigest()
+
+    def document(self, idx: int, score: Optional[float] = None, with_embedding: bool = False) -> Document:
+        """Tạo Document cho dòng thứ `idx`."""
+        return Document(
+            id=self.ids[idx],
+            content=self.contents[idx],
+            meta=self.metas[idx],
+            score=score,
+            embedding=self.embeddings[idx].astype(np.float32).tolist() if with_embedding else None,
+        )
+
+
+def save_corpus(corpus: Corpus, out_dir: str, dtype: str = "float32"):
+    """Ghi corpus ra thư mục theo định dạng embeddings.npy + documents.json (embedding được chuẩn hóa L2 trước khi ghi)."""
+    os.makedirs(out_dir, exist_ok=True)
+    embeddings = corpus.embeddings if corpus.normalized else normalize_rows(corpus.embeddings)
+    embeddings = np.ascontiguousarray(np.asarray(embeddings, dtype=dtype))
+    np.save(os.path.join(out_dir, EMBEDDINGS_FILE), embeddings)
+
+    columns = {
+        "version": FORMAT_VERSION,
+        "count": len(corpus),
+        "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+        "dtype": dtype,
+        "normalized": True,
+        "ids": corpus.ids,
+        "contents": corpus.contents,
+        "metas": corpus.metas,
+    }
+    with open(os.path.join(out_dir, DOCUMENTS_FILE), "w", encoding="utf-8") as f:
+        json.dump(columns, f, ensure_ascii=False, default=str)
+
+    # Chỉ mục ANN cũ trỏ tới các dòng của corpus cũ: xóa để không bị nạp nhầm, cần chạy lại build-index
+    index_path = os.path.join(out_dir, ANN_INDEX_FILE)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+        print(f"Đã xóa chỉ mục ANN cũ {index_path}; chạy lại build-index để xây chỉ mục mới")
+
+
+def load_corpus(corpus_dir: str, mmap: bool = True) -> Corpus:
+    """
+    Đọc corpus; ma trận embedding được memory-map (chỉ đọc) để các tiến trình dùng chung page cache.
+    Corpus ghi bởi phiên bản cũ (chưa chuẩn hóa) vẫn đọc được nhưng retriever sẽ phải chuẩn hóa một bản sao trong RAM.
+    """
+    with open(os.path.join(corpus_dir, DOCUMENTS_FILE), "r", encoding="utf-8") as f:
+        columns = json.load(f)
+    if columns.get("version") != FORMAT_VERSION:
+        raise ValueError(f"Phiên bản corpus không được hỗ trợ: {columns.get('version')}")
+
+    embeddings = np.load(os.path.join(corpus_dir, EMBEDDINGS_FILE), mmap_mode="r" if mmap else None)
+    return Corpus(embeddings, columns["ids"], columns["contents"], columns["metas"], normalized=columns.get("normalized", False))
+
+
+def corpus_exists(corpus_dir: str) -> bool:
+    return os.path.exists(os.path.join(corpus_dir, DOCUMENTS_FILE)) and os.path.exists(os.path.join(corpus_dir, EMBEDDINGS_FILE))
+
+
+def load_pickle_corpus(pickle_path: str) -> Corpus:
+    """Đọc file pickle cũ (danh sách Document của Haystack)."""
+    with open(pickle_path, "rb") as f:
+        documents = pickle.load(f)
+    return Corpus.from_documents(documents)
+
+
+def split_textbook(text: str, source: str = "math.txt", max_chars: int = 1500) -> List[Dict[str, Any]]:
+    """
+    Chia sách giáo khoa Markdown thành các đoạn theo cấu trúc Tập / Chương / § / mục.
+    Số trang được lấy từ bảng MỤC LỤC của từng tập. Mỗi đoạn có dạng {"content", "meta"},
+    nội dung được thêm dòng tiêu đề (đường dẫn chương › § › mục) để tăng chất lượng truy xuất.
+    """
+    pages: Dict[tuple, int] = {}
+    chunks: List[Dict[str, Any]] = []
+    state = {"book": 1, "chapter": None, "chapter_title": None, "section": None, "section_title": None, "subsection": None}
+    in_toc, toc_chapter = False, None
+    block: List[str] = []
+
+    def flush():
+        body = "\n".join(block).strip()
+        block.clear()
+        if not body or set(body) <= set("-\n "):
+            return
+
+        heading_path = " › ".join(
+            part for part in (
+                f"Chương {state['chapter']}: {state['chapter_title']}" if state["chapter"] else None,
+                f"{state['section']}. {state['section_title']}" if state["section"] and state["section"].startswith("§") else state["section"],
+                state["subsection"],
+            ) if part
+        )
+        page = pages.get((state["book"], state["chapter"], state["section"]))
+
+        for piece in _pack_paragraphs(body, max_chars):
+            chunks.append({
+                "content": f"{heading_path}\n{piece}" if heading_path else piece,
+                "meta": {
+                    "source": source,
+                    "book": state["book"],
+                    "chapter": state["chapter"],
+                    "chapter_title": state["chapter_title"],
+                    "section": state["section"],
+                    "section_title": state["section_title"],
+                    "subsection": state["subsection"],
+                    "page": page,
+                    "chunk_index": len(chunks),
+                },
+            })
+
+    for line in text.splitlines():
+        heading = HEADING_PATTERN.match(line)
+        if not heading:
+            if in_toc:
+                row = TOC_ROW_PATTERN.match(line)
+                if row:
+                    toc_chapter = _parse_toc_row(row, state["book"], toc_chapter, pages)
+                continue
+            block.append(line)
+            continue
+
+        flush()
+        title = heading.group(2).strip()
+        in_toc = False
+
+        if BOOK_PATTERN.search(title) and title.lower().startswith("sách giáo khoa"):
+            state.update(book=int(BOOK_PATTERN.search(title).group(1)), chapter=None, chapter_title=None,
+                         section=None, section_title=None, subsection=None)
+        elif title.upper() == "MỤC LỤC":
+            in_toc, toc_chapter = True, None
+        elif CHAPTER_PATTERN.match(title):
+            match = CHAPTER_PATTERN.match(title)
+            state.update(chapter=match.group(1), chapter_title=match.group(2), section=None, section_title=None, subsection=None)
+        elif CHAPTER_REVIEW_PATTERN.match(title):
+            chapter = CHAPTER_REVIEW_PATTERN.match(title).group(1)
+            state.update(chapter=chapter, section=f"Bài tập cuối chương {chapter}", section_title=None, subsection=None)
+        elif SECTION_PATTERN.match(title):
+            match = SECTION_PATTERN.match(title)
+            state.update(section=match.group(1), section_title=match.group(2), subsection=None)
+        elif title.upper().startswith("BẢNG") or title.lower() == "lời nói đầu":
+            # Phần ngoài các chương (lời nói đầu, bảng thuật ngữ)
+            state.update(chapter=None, chapter_title=None, section=title, section_title=None, subsection=None)
+        else:
+            state["subsection"] = title
+
+    flush()
+    return chunks
+
+
+def _parse_toc_row(row: "re.Match", book: int, toc_chapter: Optional[str], pages: Dict[tuple, int]) -> Optional[str]:
+    """Ghi số trang của một dòng MỤC LỤC vào `pages`, trả về chương hiện tại của mục lục."""
+    chapter_cell, content_cell, page_cell = (cell.strip().strip("*").strip() for cell in row.groups())
+    if re.fullmatch(r"[IVXLC]+", chapter_cell):
+        toc_chapter = chapter_cell
+    page = int(page_cell) if page_cell.isdigit() else None
+    if page is None:
+        return toc_chapter
+
+    section = SECTION_PATTERN.match(content_cell)
+    if section:
+        pages[(book, toc_chapter, section.group(1))] = page
+    elif CHAPTER_REVIEW_PATTERN.match(content_cell):
+        pages[(book, toc_chapter, f"Bài tập cuối chương {toc_chapter}")] = page
+    elif content_cell.upper().startswith("BẢNG"):
+        pages[(book, None, content_cell)] = page
+    return toc_chapter
+
+
+def _pack_paragraphs(body: str, max_chars: int) -> List[str]:
+    """Gộp các đoạn văn liên tiếp thành các khối không quá `max_chars` (đoạn quá dài giữ nguyên)."""
+    pieces, current = [], ""
+    for paragraph in re.split(r"\n\s*\n", body):
+        paragraph = paragraph.strip()
+        if not paragraph or set(paragraph) <= set("- "):
+            continue
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            pieces.append(current)
+            current = paragraph
+        else:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def content_hash(content: str, model: str = EMBEDDING_MODEL) -> str:
+    """Hash của nội dung (kèm tên model) dùng để quyết định có cần embedding lại hay không."""
+    return hashlib.sha256(f"{model}\n{content}".encode("utf-8")).hexdigest()
+
+
+def ingest_textbook(text_path: str, out_dir: str, batch_size: int = 64, max_chars: int = 1500, model: str = EMBEDDING_MODEL) -> Dict[str, int]:
+    """
+    Chia sách, embedding theo batch lớn bằng SentenceTransformersDocumentEmbedder và ghi corpus.
+    Các đoạn có content_hash đã tồn tại trong corpus cũ được dùng lại embedding, không tính lại.
+    """
+    from haystack.components.embedders import SentenceTransformersDocumentEmbedder
+
+    with open(text_path, "r", encoding="utf-8") as f:
+        chunks = split_textbook(f.read(), source=os.path.basename(text_path), max_chars=max_chars)
+
+    previous: Dict[str, np.ndarray] = {}
+    if corpus_exists(out_dir):
+        old_corpus = load_corpus(out_dir, mmap=False)
+        previous = {meta.get("content_hash"): old_corpus.embeddings[i] for i, meta in enumerate(old_corpus.metas) if meta.get("content_hash")}
+
+    for chunk in chunks:
+        chunk["meta"]["content_hash"] = content_hash(chunk["content"], model)
+    to_embed = [chunk for chunk in chunks if chunk["meta"]["content_hash"] not in previous]
+
+    new_embeddings: Dict[str, np.ndarray] = {}
+    if to_embed:
+        embedder = SentenceTransformersDocumentEmbedder(model=model, batch_size=batch_size, progress_bar=True)
+        embedder.warm_up()
+        embedded = embedder.run(documents=[Document(content=chunk["content"], meta=chunk["meta"]) for chunk in to_embed])["documents"]
+        new_embeddings = {doc.meta["content_hash"]: np.asarray(doc.embedding, dtype=np.float32) for doc in embedded}
+
+    documents = [
+        Document(content=chunk["content"], meta=chunk["meta"])
+        for chunk in chunks
+    ]
+    embeddings = np.stack([
+        new_embeddings.get(chunk["meta"]["content_hash"], previous.get(chunk["meta"]["content_hash"]))
+        for chunk in chunks
+    ]).astype(np.float32)
+
+    corpus = Corpus(
+        embeddings=embeddings,
+        ids=[doc.id for doc in documents],
+        contents=[doc.content for doc in documents],
+        metas=[doc.meta for doc in documents],
+    )
+    save_corpus(corpus, out_dir)
+    return {"chunks": len(chunks), "embedded": len(to_embed), "reused": len(chunks) - len(to_embed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Công cụ quản lý corpus học liệu")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Chuyển file pickle sang định dạng memmap")
+    export_parser.add_argument("pickle_path", nargs="?", default="embedded_documents.pkl")
+    export_parser.add_argument("out_dir", nargs="?", default="corpus")
+    export_parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+
+    ingest_parser = subparsers.add_parser("ingest", help="Chia và embedding sách giáo khoa thành corpus")
+    ingest_parser.add_argument("text_path", nargs="?", default="math.txt")
+    ingest_parser.add_argument("out_dir", nargs="?", default="corpus")
+    ingest_parser.add_argument("--batch-size", type=int, default=64)
+    ingest_parser.add_argument("--max-chars", type=int, default=1500, help="Độ dài tối đa của một đoạn (ký tự)")
+    ingest_parser.add_argument("--model", default=EMBEDDING_MODEL)
+    ingest_parser.add_argument("--dry-run", action="store_true", help="Chỉ chia đoạn và in thống kê, không embedding")
+
+    index_parser = subparsers.add_parser("build-index", help="Xây chỉ mục IVF cho corpus")
+    index_parser.add_argument("corpus_dir", nargs="?", default="corpus")
+    index_parser.add_argument("--n-lists", type=int, default=None, help="Số cụm (mặc định sqrt(n))")
+    index_parser.add_argument("--nprobe", type=int, default=8, help="Số cụm quét mặc định khi truy vấn")
+    index_parser.add_argument("--n-iter", type=int, default=20)
+
+    report_parser = subparsers.add_parser("recall-report", help="So sánh recall/độ trễ của IVF với tìm kiếm chính xác")
+    report_parser.add_argument("corpus_dir", nargs="?", default="corpus")
+    report_parser.add_argument("--k", type=int, default=10)
+    report_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    report_parser.add_argument("--n-queries", type=int, default=200)
+    report_parser.add_argument("--noise", type=float, default=0.05, help="Nhiễu thêm vào embedding tài liệu để làm truy vấn mẫu")
+
+    args = parser.parse_args()
+
+    if args.command == "export":
+        corpus = load_pickle_corpus(args.pickle_path)
+        save_corpus(corpus, args.out_dir, dtype=args.dtype)
+        print(f"Đã ghi {len(corpus)} documents ({args.dtype}) vào {args.out_dir}/")
+
+    elif args.command == "ingest":
+        if args.dry_run:
+            with open(args.text_path, "r", encoding="utf-8") as f:
+                chunks = split_textbook(f.read(), source=os.path.basename(args.text_path), max_chars=args.max_chars)
+            for chunk in chunks:
+                meta = chunk["meta"]
+                print(f"[{meta['book']}|{meta['chapter']}|{meta['section']}|{meta['subsection']}|p.{meta['page']}] {len(chunk['content'])} chars")
+            print(f"Tổng cộng {len(chunks)} đoạn")
+        else:
+            start = time.perf_counter()
+            stats = ingest_textbook(args.text_path, args.out_dir, batch_size=args.batch_size, max_chars=args.max_chars, model=args.model)
+            print(f"Đã ghi {stats['chunks']} đoạn vào {args.out_dir}/ (embedding mới: {stats['embedded']}, dùng lại: {stats['reused']}) trong {time.perf_counter() - start:.1f}s")
+
+    elif args.command == "build-index":
+        from retrieval_utils import IVFIndex
+
+        corpus = load_corpus(args.corpus_dir)
+        index = IVFIndex.build(corpus.embeddings, n_lists=args.n_lists, n_iter=args.n_iter, nprobe=args.nprobe, fingerprint=corpus.fingerprint())
+        index.save(os.path.join(args.corpus_dir, ANN_INDEX_FILE))
+        print(f"Đã xây chỉ mục IVF {index.n_lists} cụm cho {index.size} documents")
+
+    elif args.command == "recall-report":
+        from retrieval_utils import IVFIndex, recall_report
+
+        corpus = load_corpus(args.corpus_dir)
+        index = IVFIndex.load(os.path.join(args.corpus_dir, ANN_INDEX_FILE))
+        rng = np.random.default_rng(0)
+        sample = np.asarray(corpus.embeddings[rng.choice(len(corpus), size=min(args.n_queries, len(corpus)), replace=False)], dtype=np.float32)
+        queries = sample + rng.normal(scale=args.noise, size=sample.shape).astype(np.float32) * np.linalg.norm(sample, axis=1, keepdims=True) / np.sqrt(sample.shape[1])
+
+        print(f"{'nprobe':>6} {'recall@' + str(args.k):>10} {'exact ms':>9} {'ann ms':>8}")
+        for row in recall_report(corpus.embeddings, index, queries, k=args.k, nprobe_values=args.nprobe):
+            print(f"{row['nprobe']:>6} {row['recall_at_k']:>10.3f} {row['exact_ms_per_query']:>9.3f} {row['ann_ms_per_query']:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+Các backend embedding cho vietnamese-bi-encoder.
+
+Backend ONNX Runtime (int8) tùy chọn, không cần torch khi phục vụ:
+    python embedding_utils.py export-onnx --out onnx_model
+    python embedding_utils.py parity --onnx-dir onnx_model
+rồi chạy ứng dụng với EMBEDDING_BACKEND=onnx (và ONNX_MODEL_DIR nếu khác onnx_model).
+"""
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+from haystack import Document, component
+
+EMBEDDING_MODEL = "bkai-foundation-models/vietnamese-bi-encoder"
+ONNX_CONFIG_FILE = "onnx_config.json"
+ONNX_FP32_FILE = "model.onnx"
+ONNX_INT8_FILE = "model.int8.onnx"
+
+
+def document_embedder_batch_fn(document_embedder: Any) -> Callable[[List[str]], List[List[float]]]:
+    """
+    Hàm embedding theo batch dựa trên SentenceTransformersDocumentEmbedder (đã warm_up).
+    Haystack dùng chung model giữa Text/Document embedder có cùng cấu hình nên không tải thêm model.
+    """
+    def embed_batch(texts: List[str]) -> List[List[float]]:
+        documents = document_embedder.run(documents=[Document(content=text) for text in texts])["documents"]
+        return [doc.embedding for doc in documents]
+    return embed_batch
+
+
+@component
+class BatchingEmbeddingService:
+    """
+    Dịch vụ embedding dùng chung giữa các phiên Streamlit.
+    Các request được đưa vào hàng đợi; một worker gom chúng thành một batch và chạy một forward pass
+    khi batch đầy hoặc sau `max_wait_ms`. Người gọi nhận về Future (hoặc dùng `run` như một text embedder).
+    """
+
+    def __init__(self, embed_batch: Callable[[List[str]], List[List[float]]], max_batch_size: int = 32, max_wait_ms: float = 5):
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "batches": 0, "max_batch_size": 0, "busy_seconds": 0.0}
+        self._worker = threading.Thread(target=self._run_worker, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, text: str) -> Future:
+        future: Future = Future()
+        self._queue.put((text, future))
+        return future
+
+    @component.output_types(embedding=List[float])
+    def run(self, text: str):
+        return {"embedding": self.submit(text).result()}
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            batches = self._stats["batches"]
+            return {
+                **self._stats,
+                "queue_depth": self._queue.qsize(),
+                "avg_batch_size": self._stats["requests"] / batches if batches else 0.0,
+            }
+
+    def _run_worker(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            try:
+                embeddings = self.embed_batch([text for text, _ in batch])
+                for (_, future), embedding in zip(batch, embeddings):
+                    future.set_result(embedding)
+            except Exception as e:
+                print(f"ERROR: [Embedding Service] Batch of {len(batch)} failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+
+            with self._lock:
+                self._stats["requests"] += len(batch)
+                self._stats["batches"] += 1
+                self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(batch))
+                self._stats["busy_seconds"] += time.perf_counter() - start
+
+
+class OnnxEmbeddingBackend:
+    """
+    Embedding bằng onnxruntime trên model đã export (mặc định bản int8 lượng tử hóa động).
+    Tái tạo pooling/normalize của SentenceTransformer từ onnx_config.json được ghi lúc export.
+    """
+
+    def __init__(self, model_dir: str = "onnx_model", quantized: bool = True, intra_op_threads: Optional[int] = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, ONNX_CONFIG_FILE), "r", encoding="utf-8") as f:
+            self.config = json.load(f)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+        options = ort.SessionOptions()
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        model_path = os.path.join(model_dir, ONNX_INT8_FILE if quantized else ONNX_FP32_FILE)
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        encoded = self.tokenizer(
+            texts, padding=True, truncation=True, max_length=self.config["max_seq_length"], return_tensors="np"
+        )
+        inputs = {name: encoded[name].astype(np.int64) for name in self.input_names}
+        hidden = self.session.run(None, inputs)[0]
+
+        if self.config["pooling"] == "cls":
+            embeddings = hidden[:, 0]
+        else:
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            embeddings = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        if self.config.get("normalize"):
+            embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings.astype(np.float32).tolist()
+
+
+def export_onnx(model_name: str = EMBEDDING_MODEL, out_dir: str = "onnx_model", quantize: bool = True, opset: int = 14):
+    """Export transformer của SentenceTransformer sang ONNX (chạy một lần, cần torch) và lượng tử hóa int8 động."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    st_model = SentenceTransformer(model_name, device="cpu")
+    transformer = st_model[0].auto_model.eval()
+    tokenizer = st_model.tokenizer
+    pooling_mode = st_model[1].get_pooling_mode_str() if len(st_model) > 1 else "mean"
+
+    class _LastHiddenState(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+    os.makedirs(out_dir, exist_ok=True)
+    dummy = tokenizer(["Giải phương trình x + 5 = 10"], return_tensors="pt")
+    fp32_path = os.path.join(out_dir, ONNX_FP32_FILE)
+    torch.onnx.export(
+        _LastHiddenState(transformer),
+        (dummy["input_ids"], dummy["attention_mask"]),
+        fp32_path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["last_hidden_state"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "last_hidden_state": {0: "batch", 1: "sequence"},
+        },
+        opset_version=opset,
+    )
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_path, os.path.join(out_dir, ONNX_INT8_FILE), weight_type=QuantType.QInt8)
+
+    tokenizer.save_pretrained(out_dir)
+    with open(os.path.join(out_dir, ONNX_CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "model_name": model_name,
+            "pooling": "cls" if pooling_mode == "cls" else "mean",
+            "normalize": any(type(module).__name__ == "Normalize" for module in st_model),
+            "max_seq_length": st_model.max_seq_length,
+        }, f, ensure_ascii=False, indent=2)
+
+
+def parity_check(texts: List[str], onnx_dir: str = "onnx_model", model_name: str = EMBEDDING_MODEL, quantized: bool = True, min_cosine: float = 0.99) -> Dict[str, float]:
+    """So sánh embedding ONNX với PyTorch (cosine từng câu) và độ trễ trung bình cho truy vấn đơn lẻ."""
+    from sentence_transformers import SentenceTransformer
+
+    st_model = SentenceTransformer(model_name, device="cpu")
+    onnx_backend = OnnxEmbeddingBackend(onnx_dir, quantized=quantized)
+
+    torch_vectors = np.asarray(st_model.encode(texts), dtype=np.float32)
+    onnx_vectors = np.asarray(onnx_backend.embed_batch(texts), dtype=np.float32)
+    cosines = (torch_vectors * onnx_vectors).sum(axis=1) / (
+        np.linalg.norm(torch_vectors, axis=1) * np.linalg.norm(onnx_vectors, axis=1)
+    )
+
+    def latency_ms(embed: Callable[[List[str]], Any]) -> float:
+        start = time.perf_counter()
+        for text in texts:
+            embed([text])
+        return (time.perf_counter() - start) * 1000 / len(texts)
+
+    torch_ms = latency_ms(st_model.encode)
+    onnx_ms = latency_ms(onnx_backend.embed_batch)
+    return {
+        "min_cosine": float(cosines.min()),
+        "mean_cosine": float(cosines.mean()),
+        "passed": bool(cosines.min() >= min_cosine),
+        "torch_ms_per_query": torch_ms,
+        "onnx_ms_per_query": onnx_ms,
+        "speedup": torch_ms / onnx_ms if onnx_ms else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Công cụ backend embedding")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export-onnx", help="Export model sang ONNX và lượng tử hóa int8")
+    export_parser.add_argument("--model", default=EMBEDDING_MODEL)
+    export_parser.add_argument("--out", default="onnx_model")
+    export_parser.add_argument("--no-quantize", action="store_true")
+
+    parity_parser = subparsers.add_parser("parity", help="Kiểm tra độ khớp và độ trễ ONNX so với PyTorch")
+    parity_parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parity_parser.add_argument("--onnx-dir", default="onnx_model")
+    parity_parser.add_argument("--fp32", action="store_true", help="Dùng bản ONNX fp32 thay vì int8")
+
+    args = parser.parse_args()
+
+    if args.command == "export-onnx":
+        export_onnx(args.model, args.out, quantize=not args.no_quantize)
+        print(f"Đã export ONNX vào {args.out}/")
+    elif args.command == "parity":
+        from intent_utils import INTENT_EXAMPLES
+
+        texts = [text for examples in INTENT_EXAMPLES.values() for text in examples]
+        report = parity_check(texts, args.onnx_dir, args.model, quantized=not args.fp32)
+        for key, value in report.items():
+            print(f"{key}: {value}")
+        if not report["passed"]:
+            raise SystemExit("Cosine tối thiểu thấp hơn 0.99, không nên dùng backend ONNX này")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,528 @@
+import time
+import heapq
+import hashlib
+import random
+import asyncio
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Dict, Iterator, List, Optional
+
+from google.api_core import exceptions as google_exceptions
+
+from retrieval_utils import estimate_tokens
+
+# Thời gian tối đa cho một lần gọi Gemini của từng agent (giây)
+AGENT_TIMEOUTS = {
+    "intent": 8,
+    "ocr": 30,
+    "informer": 60,
+    "verifier": 30,
+    "insight": 30,
+    "practice": 45,
+    "tutor": 30,
+    "default": 30,
+}
+
+# Model và cấu hình sinh của từng agent; agent không có trong bảng dùng route "default".
+# Có thể ghi đè từng trường qua GEMINI_ROUTES (JSON), ví dụ {"intent": {"model_name": "gemini-1.5-flash-8b"}}
+AGENT_ROUTES = {
+    "default": {"model_name": "gemini-1.5-pro", "temperature": 0.2, "max_output_tokens": 1024},
+    "informer": {"model_name": "gemini-1.5-pro", "temperature": 0.2, "max_output_tokens": 1024},
+    # Chỉ cần một nhãn intent: model nhanh, vài token đầu ra
+    "intent": {"model_name": "gemini-1.5-flash", "temperature": 0.0, "max_output_tokens": 16},
+    # Verifier/insight chỉ trả về JSON: bật JSON mode để không phải bóc JSON khỏi văn bản tự do
+    "verifier": {"model_name": "gemini-1.5-pro", "temperature": 0.0, "max_output_tokens": 512, "response_mime_type": "application/json"},
+    "insight": {"model_name": "gemini-1.5-flash", "temperature": 0.0, "max_output_tokens": 512, "response_mime_type": "application/json"},
+}
+
+
+def resolve_routes(overrides: Optional[Dict[str, Dict[str, Any]]] = None) -> Dict[str, Dict[str, Any]]:
+    """Gộp bảng route mặc định với phần ghi đè (từng trường của từng agent)."""
+    routes = {agent: dict(route) for agent, route in AGENT_ROUTES.items()}
+    for agent, route in (overrides or {}).items():
+        routes[agent] = {**routes.get(agent, routes["default"]), **route}
+    return routes
+
+
+# Làn ưu tiên của bộ giới hạn: số nhỏ hơn được cấp quota trước
+INTERACTIVE = 0
+BACKGROUND = 1
+PROACTIVE = 2
+LANE_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background", PROACTIVE: "proactive"}
+
+# Làn mặc định theo agent; người gọi có thể chỉ định riêng (ví dụ luồng đề xuất chủ động)
+AGENT_PRIORITIES = {"verifier": BACKGROUND, "insight": PROACTIVE}
+
+# Số token ước lượng cho một ảnh đầu vào của Gemini
+IMAGE_TOKENS = 258
+
+RATE_LIMITED = "rate_limited"
+QUEUE_TIMEOUT = "queue_timeout"
+UNAVAILABLE = "unavailable"
+TIMEOUT = "timeout"
+BLOCKED = "blocked"
+INVALID_REQUEST = "invalid_request"
+AUTH = "auth"
+UNKNOWN = "unknown"
+
+RETRYABLE_ERRORS = {RATE_LIMITED, UNAVAILABLE, TIMEOUT}
+
+ERROR_MESSAGES = {
+    RATE_LIMITED: "Xin lỗi, hệ thống AI đang quá tải. Vui lòng thử lại sau ít phút.",
+    UNAVAILABLE: "Xin lỗi, dịch vụ AI tạm thời không khả dụng. Vui lòng thử lại.",
+    TIMEOUT: "Xin lỗi, mô hình AI phản hồi quá chậm. Vui lòng thử lại.",
+    QUEUE_TIMEOUT: "Xin lỗi, hệ thống đang có nhiều yêu cầu cùng lúc. Vui lòng thử lại sau giây lát.",
+    BLOCKED: "Xin lỗi, mô hình AI từ chối trả lời nội dung này.",
+    INVALID_REQUEST: "Xin lỗi, yêu cầu gửi tới mô hình AI không hợp lệ.",
+    AUTH: "Xin lỗi, không thể xác thực với dịch vụ AI.",
+    UNKNOWN: "Xin lỗi, đã có lỗi xảy ra khi kết nối với mô hình AI.",
+}
+
+
+class GeminiCallError(RuntimeError):
+    """Lỗi của một lượt gọi Gemini, kèm kết quả lỗi có cấu trúc trong `error`."""
+
+    def __init__(self, error: Dict[str, Any]):
+        super().__init__(ERROR_MESSAGES.get(error["type"], ERROR_MESSAGES[UNKNOWN]))
+        self.error = error
+
+
+class RateLimitTimeout(Exception):
+    """Chờ quota của bộ giới hạn quá thời gian cho phép của làn."""
+
+
+def classify_error(e: BaseException) -> str:
+    if isinstance(e, RateLimitTimeout):
+        return QUEUE_TIMEOUT
+    if isinstance(e, asyncio.TimeoutError):
+        return TIMEOUT
+    if isinstance(e, google_exceptions.TooManyRequests):
+        return RATE_LIMITED
+    if isinstance(e, (
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.BadGateway,
+        google_exceptions.GatewayTimeout,
+        google_exceptions.DeadlineExceeded,
+    )):
+        return UNAVAILABLE
+    if isinstance(e, (google_exceptions.Unauthenticated, google_exceptions.PermissionDenied)):
+        return AUTH
+    if isinstance(e, (google_exceptions.InvalidArgument, google_exceptions.BadRequest)):
+        return INVALID_REQUEST
+    # response.text ném ValueError khi câu trả lời bị chặn hoặc không có candidate
+    if isinstance(e, ValueError) or type(e).__name__ in ("BlockedPromptException", "StopCandidateException"):
+        return BLOCKED
+    return UNKNOWN
+
+
+def estimate_prompt_tokens(parts: List[Any]) -> int:
+    return sum(estimate_tokens(part) if isinstance(part, str) else IMAGE_TOKENS for part in parts)
+
+
+def response_tokens(response: Any) -> Optional[int]:
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) or None
+
+
+class TokenBucketLimiter:
+    """
+    Bộ giới hạn quota Gemini dùng chung toàn tiến trình: hai token bucket theo số request/phút (RPM)
+    và số token/phút (TPM). Các lượt gọi xếp hàng theo làn ưu tiên (interactive trước background/proactive),
+    mỗi làn chỉ chờ tối đa `max_wait` giây rồi bỏ cuộc với RateLimitTimeout thay vì dồn lỗi 429 lên API.
+    Chỉ được dùng từ event loop của GeminiClient.
+    """
+
+    def __init__(self, requests_per_minute: float = 60, tokens_per_minute: float = 1_000_000, max_wait: Optional[Dict[int, float]] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_wait = {INTERACTIVE: 20, BACKGROUND: 60, PROACTIVE: 30, **(max_wait or {})}
+
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._waiters: List[Any] = []
+        self._sequence = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        self._lock = threading.Lock()
+        self._lanes = {
+            lane: {"granted": 0, "timed_out": 0, "waits": deque(maxlen=500)} for lane in LANE_NAMES
+        }
+
+    async def acquire(self, tokens: int, priority: int = INTERACTIVE):
+        # Một request lớn hơn cả bucket sẽ không bao giờ được cấp, nên giới hạn ở dung lượng bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            heapq.heappush(self._waiters, (priority, next(self._sequence), tokens, future))
+        start = time.monotonic()
+        self._pump()
+        try:
+            await asyncio.wait_for(future, self.max_wait[priority])
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._lanes[priority]["timed_out"] += 1
+            # Request đứng đầu hàng vừa bỏ cuộc có thể đang chặn các request nhỏ hơn phía sau
+            self._pump()
+            raise RateLimitTimeout(f"Chờ quota quá {self.max_wait[priority]}s ở làn {LANE_NAMES[priority]}")
+        with self._lock:
+            self._lanes[priority]["granted"] += 1
+            self._lanes[priority]["waits"].append(time.monotonic() - start)
+
+    def settle(self, reserved: int, actual: Optional[int]):
+        """Điều chỉnh bucket TPM theo số token thực tế của response (hoàn lại hoặc ghi nợ phần chênh lệch)."""
+        if actual is None:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens + reserved - actual, float(self.tokens_per_minute))
+        self._pump()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refill()
+            depth = {lane: 0 for lane in LANE_NAMES}
+            for priority, _, _, future in self._waiters:
+                if not future.done():
+                    depth[priority] += 1
+            lanes = {}
+            for lane, name in LANE_NAMES.items():
+                waits = sorted(self._lanes[lane]["waits"])
+                lanes[name] = {
+                    "queue_depth": depth[lane],
+                    "granted": self._lanes[lane]["granted"],
+                    "timed_out": self._lanes[lane]["timed_out"],
+                    "p95_wait_seconds": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                }
+            return {
+                "requests_available": round(self._requests, 2),
+                "tokens_available": int(self._tokens),
+                "lanes": lanes,
+            }
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self._requests + elapsed * self.requests_per_minute / 60, float(self.requests_per_minute))
+        self._tokens = min(self._tokens + elapsed * self.tokens_per_minute / 60, float(self.tokens_per_minute))
+
+    def _pump(self):
+        """Cấp quota cho các request đứng đầu hàng; nếu chưa đủ thì hẹn giờ thử lại khi bucket nạp đủ."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._refill()
+            while self._waiters:
+                _, _, tokens, future = self._waiters[0]
+                if future.done():
+                    heapq.heappop(self._waiters)
+                    continue
+                if self._requests >= 1 and self._tokens >= tokens:
+                    heapq.heappop(self._waiters)
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    future.set_result(None)
+                    continue
+                delay = max(
+                    (1 - self._requests) * 60 / self.requests_per_minute,
+                    (tokens - self._tokens) * 60 / self.tokens_per_minute,
+                    0.01,
+                )
+                self._timer = asyncio.get_running_loop().call_later(delay, self._pump)
+                break
+
+
+def prompt_key(model: Any, parts: List[Any], agent: str, output_tokens: int, stream: bool) -> str:
+    """Hash của toàn bộ prompt (kể cả bytes ảnh) cùng model/agent, dùng để gộp các lượt gọi trùng nhau."""
+    digest = hashlib.sha256()
+    for field in (getattr(model, "model_name", ""), agent, str(output_tokens), str(stream)):
+        digest.update(field.encode("utf-8") + b"\x00")
+    for part in parts:
+        if isinstance(part, str):
+            digest.update(b"text\x00" + part.encode("utf-8"))
+        elif isinstance(part, bytes):
+            digest.update(b"bytes\x00" + part)
+        elif isinstance(part, dict):
+            digest.update(b"blob\x00" + part.get("mime_type", "").encode("utf-8") + b"\x00" + part.get("data", b""))
+        else:
+            digest.update(b"repr\x00" + repr(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class _SharedStream:
+    """Các đoạn của một lượt stream, được phát lại cho mọi người đọc (kể cả người đến sau)."""
+
+    def __init__(self):
+        self._items: List[Any] = []
+        self._condition = threading.Condition()
+
+    def put(self, item: Any):
+        with self._condition:
+            self._items.append(item)
+            self._condition.notify_all()
+
+    def read(self) -> Iterator[Any]:
+        index = 0
+        while True:
+            with self._condition:
+                while index >= len(self._items):
+                    self._condition.wait()
+                item = self._items[index]
+            index += 1
+            yield item
+            if item[0] != "chunk":
+                return
+
+
+class GeminiClient:
+    """
+    Client Gemini dùng chung cho mọi agent, chạy `generate_content_async` trên một event loop nền.
+    Một loop duy nhất giữ kết nối gRPC của SDK được tái sử dụng giữa các lượt gọi.
+    Giới hạn số lượt gọi đồng thời, timeout theo agent, thử lại lỗi tạm thời (429/5xx/timeout)
+    với backoff lũy thừa có jitter, và trả về lỗi có cấu trúc thay vì một câu xin lỗi.
+    Các lượt gọi giống hệt nhau đang chạy cùng lúc (single-flight) chỉ gửi một request lên API.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        timeouts: Optional[Dict[str, float]] = None,
+        limiter: Optional[TokenBucketLimiter] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeouts = {**AGENT_TIMEOUTS, **(timeouts or {})}
+        self.limiter = limiter
+
+        self._loop = asyncio.new_event_loop()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._thread = threading.Thread(target=self._loop.run_forever, name="gemini-client", daemon=True)
+        self._thread.start()
+
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "succeeded": 0, "failed": 0, "retries": 0, "in_flight": 0, "latency_seconds": 0.0}
+        self._errors: Dict[str, int] = {}
+        self._routes: Dict[str, Dict[str, Any]] = {}
+        self._inflight: Dict[str, Any] = {}
+        self._coalescing = {"requests": 0, "coalesced": 0}
+
+    def timeout_for(self, agent: str) -> float:
+        return self.timeouts.get(agent, self.timeouts["default"])
+
+    def priority_for(self, agent: str, priority: Optional[int] = None) -> int:
+        return priority if priority is not None else AGENT_PRIORITIES.get(agent, INTERACTIVE)
+
+    def submit(self, model: Any, parts: List[Any], agent: str = "default", priority: Optional[int] = None, output_tokens: int = 1024) -> Future:
+        """
+        Gửi một lượt gọi lên event loop nền, trả về Future của kết quả có cấu trúc.
+        Nếu một lượt gọi với cùng prompt đang chạy thì dùng chung Future của nó.
+        """
+        key = prompt_key(model, parts, agent, output_tokens, stream=False)
+        with self._lock:
+            self._coalescing["requests"] += 1
+            future = self._inflight.get(key)
+            if future is not None:
+                self._coalescing["coalesced"] += 1
+                return future
+            future = asyncio.run_coroutine_threadsafe(
+                self._generate(model, parts, agent, self.priority_for(agent, priority), output_tokens), self._loop
+            )
+            self._inflight[key] = future
+        future.add_done_callback(lambda _: self._release_inflight(key, future))
+        return future
+
+    def generate(self, model: Any, parts: List[Any], agent: str = "default", priority: Optional[int] = None, output_tokens: int = 1024) -> Dict[str, Any]:
+        """Gọi đồng bộ: `{"replies", "meta", "error"}`; `error` là None nếu thành công."""
+        return self.submit(model, parts, agent, priority, output_tokens).result()
+
+    def stream(self, model: Any, parts: List[Any], agent: str = "default", priority: Optional[int] = None, output_tokens: int = 1024) -> Iterator[str]:
+        """
+        Stream từng đoạn văn bản. Chỉ thử lại khi chưa nhận được đoạn nào;
+        lỗi cuối cùng được ném ra dưới dạng GeminiCallError.
+        """
+        key = prompt_key(model, parts, agent, output_tokens, stream=True)
+        with self._lock:
+            self._coalescing["requests"] += 1
+            chunks = self._inflight.get(key)
+            if chunks is not None:
+                self._coalescing["coalesced"] += 1
+            else:
+                chunks = _SharedStream()
+                self._inflight[key] = chunks
+                asyncio.run_coroutine_threadsafe(
+                    self._stream(model, parts, agent, self.priority_for(agent, priority), output_tokens, key, chunks), self._loop
+                )
+        for kind, value in chunks.read():
+            if kind == "chunk":
+                yield value
+            elif kind == "error":
+                raise GeminiCallError(value)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            finished = self._stats["succeeded"] + self._stats["failed"]
+            stats = {
+                **self._stats,
+                "avg_latency_seconds": self._stats["latency_seconds"] / finished if finished else 0.0,
+                "errors": dict(self._errors),
+                **self._coalescing,
+                "coalescing_ratio": self._coalescing["coalesced"] / self._coalescing["requests"] if self._coalescing["requests"] else 0.0,
+            }
+            stats["routes"] = {
+                agent: {
+                    "model": route["model"],
+                    "calls": route["calls"],
+                    "failed": route["failed"],
+                    "avg_latency_seconds": sum(route["latencies"]) / len(route["latencies"]) if route["latencies"] else 0.0,
+                    "p95_latency_seconds": sorted(route["latencies"])[int(0.95 * (len(route["latencies"]) - 1))] if route["latencies"] else 0.0,
+                }
+                for agent, route in self._routes.items()
+            }
+        if self.limiter is not None:
+            stats["rate_limiter"] = self.limiter.stats()
+        return stats
+
+    async def _acquire(self, parts: List[Any], priority: int, output_tokens: int) -> int:
+        """Xin quota trước mỗi lần gửi (kể cả thử lại); trả về số token đã giữ chỗ."""
+        if self.limiter is None:
+            return 0
+        reserved = estimate_prompt_tokens(parts) + output_tokens
+        await self.limiter.acquire(reserved, priority)
+        return reserved
+
+    def _settle(self, reserved: int, response: Any):
+        if self.limiter is not None:
+            self.limiter.settle(reserved, response_tokens(response))
+
+    async def _generate(self, model: Any, parts: List[Any], agent: str, priority: int, output_tokens: int) -> Dict[str, Any]:
+        start = time.perf_counter()
+        timeout = self.timeout_for(agent)
+        self._record_start(agent, model)
+        attempt = 0
+        while True:
+            try:
+                reserved = await self._acquire(parts, priority, output_tokens)
+                async with self._get_semaphore():
+                    response = await asyncio.wait_for(model.generate_content_async(parts), timeout)
+                self._settle(reserved, response)
+                text = response.text
+                meta = {
+                    "agent": agent, "model": getattr(model, "model_name", ""),
+                    "attempts": attempt + 1, "latency_seconds": time.perf_counter() - start,
+                }
+                self._record_end(agent, meta["latency_seconds"])
+                return {"replies": [text], "meta": meta, "error": None}
+            except Exception as e:
+                if await self._should_retry(e, attempt, agent):
+                    attempt += 1
+                    continue
+                return self._error_result(e, agent, attempt, start)
+
+    async def _stream(self, model: Any, parts: List[Any], agent: str, priority: int, output_tokens: int, key: str, chunks: _SharedStream):
+        start = time.perf_counter()
+        timeout = self.timeout_for(agent)
+        self._record_start(agent, model)
+        attempt = 0
+        received = False
+        while True:
+            try:
+                reserved = await self._acquire(parts, priority, output_tokens)
+                async with self._get_semaphore():
+                    response = await asyncio.wait_for(model.generate_content_async(parts, stream=True), timeout)
+                    iterator = response.__aiter__()
+                    chunk = None
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(iterator.__anext__(), timeout)
+                        except StopAsyncIteration:
+                            break
+                        try:
+                            text = chunk.text
+                        except ValueError:
+                            # Chunk không có văn bản (ví dụ chunk kết thúc), bỏ qua
+                            continue
+                        if text:
+                            received = True
+                            chunks.put(("chunk", text))
+                # Chunk cuối mang usage_metadata của cả response
+                self._settle(reserved, chunk)
+                self._record_end(agent, time.perf_counter() - start)
+                self._release_inflight(key, chunks)
+                chunks.put(("done", None))
+                return
+            except Exception as e:
+                if not received and await self._should_retry(e, attempt, agent):
+                    attempt += 1
+                    continue
+                error = self._error_result(e, agent, attempt, start)["error"]
+                self._release_inflight(key, chunks)
+                chunks.put(("error", error))
+                return
+
+    async def _should_retry(self, e: BaseException, attempt: int, agent: str) -> bool:
+        error_type = classify_error(e)
+        if error_type not in RETRYABLE_ERRORS or attempt >= self.max_retries:
+            return False
+        # Full jitter: tránh các phiên cùng thử lại đúng một thời điểm sau khi bị 429/503
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        print(f"DEBUG: [Gemini] {agent} call failed ({error_type}: {e!r}), retrying in {delay:.2f}s")
+        with self._lock:
+            self._stats["retries"] += 1
+        await asyncio.sleep(delay)
+        return True
+
+    def _error_result(self, e: BaseException, agent: str, attempt: int, start: float) -> Dict[str, Any]:
+        error_type = classify_error(e)
+        latency = time.perf_counter() - start
+        print(f"ERROR: [Gemini] {agent} call failed after {attempt + 1} attempt(s) ({error_type}): {e!r}")
+        with self._lock:
+            self._stats["in_flight"] -= 1
+            self._stats["failed"] += 1
+            self._stats["latency_seconds"] += latency
+            self._routes[agent]["failed"] += 1
+            self._routes[agent]["latencies"].append(latency)
+            self._errors[error_type] = self._errors.get(error_type, 0) + 1
+        error = {
+            "type": error_type,
+            "message": str(e) or type(e).__name__,
+            "retryable": error_type in RETRYABLE_ERRORS,
+            "attempts": attempt + 1,
+        }
+        return {"replies": [], "meta": {"agent": agent, "attempts": attempt + 1, "latency_seconds": latency}, "error": error}
+
+    def _release_inflight(self, key: str, entry: Any):
+        with self._lock:
+            if self._inflight.get(key) is entry:
+                del self._inflight[key]
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Tạo trong thread của event loop để semaphore gắn với đúng loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def _record_start(self, agent: str, model: Any):
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["in_flight"] += 1
+            route = self._routes.setdefault(agent, {"model": "", "calls": 0, "failed": 0, "latencies": deque(maxlen=500)})
+            route["model"] = getattr(model, "model_name", "")
+            route["calls"] += 1
+
+    def _record_end(self, agent: str, latency: float):
+        with self._lock:
+            self._stats["in_flight"] -= 1
+            self._stats["succeeded"] += 1
+            self._stats["latency_seconds"] += latency
+            self._routes[agent]["latencies"].append(latency)
@@ -0,0 +1,125 @@
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+from PIL import Image, ImageOps
+
+OCR = "ocr"
+VISION = "vision"
+
+
+def content_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ImagePreprocessor:
+    """
+    Chuẩn bị ảnh tải lên trước khi gửi cho Gemini, cache theo hash nội dung.
+    Mỗi ảnh chỉ được giải mã một lần: xoay theo EXIF, thu nhỏ về cạnh dài tối đa `max_side`,
+    rồi mã hóa lại thành JPEG (ảnh xám cho OCR). Kết quả là blob `{"mime_type", "data"}`
+    dùng lại được giữa lượt OCR (Stage 1) và lượt giải bài (Stage 4).
+    Ảnh đã giải mã (~7.7 MB RGB ở 1600 px) chỉ được giữ trong một cache rất nhỏ (`max_decoded`) và bị bỏ
+    ngay khi cả hai blob OCR/VISION đã có; lâu dài chỉ giữ các blob JPEG và dấu vân ảnh.
+    """
+
+    def __init__(self, max_side: int = 1600, jpeg_quality: int = 85, ocr_grayscale: bool = True, max_entries: int = 64, max_decoded: int = 2):
+        self.max_side = max_side
+        self.jpeg_quality = jpeg_quality
+        self.ocr_grayscale = ocr_grayscale
+        self.max_entries = max_entries
+        self.max_decoded = max_decoded
+        self._decoded: "OrderedDict[str, Image.Image]" = OrderedDict()
+        self._prepared: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self._fingerprints: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "decodes": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def prepare(self, image_bytes: bytes, purpose: str = VISION) -> Dict[str, Any]:
+        """Trả về blob ảnh đã xử lý cho `purpose` (OCR hoặc VISION)."""
+        digest = content_digest(image_bytes)
+        key = (digest, purpose)
+        with self._lock:
+            blob = self._prepared.get(key)
+            if blob is not None:
+                self._prepared.move_to_end(key)
+                self._stats["hits"] += 1
+                return blob
+            self._stats["misses"] += 1
+
+        image = self._decode(digest, image_bytes)
+        if purpose == OCR and self.ocr_grayscale:
+            image = image.convert("L")
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=self.jpeg_quality, optimize=True)
+        blob = {"mime_type": "image/jpeg", "data": buffer.getvalue()}
+
+        with self._lock:
+            self._prepared[key] = blob
+            while len(self._prepared) > self.max_entries:
+                self._prepared.popitem(last=False)
+            if (digest, OCR) in self._prepared and (digest, VISION) in self._prepared:
+                self._decoded.pop(digest, None)
+            self._stats["bytes_in"] += len(image_bytes)
+            self._stats["bytes_out"] += len(blob["data"])
+        return blob
+
+    def fingerprint(self, image_bytes: bytes, size: int = 128) -> bytes:
+        """
+        Dấu vân ảnh: ảnh xám cỡ OCR (đã xoay/thu nhỏ) thu về lưới `size`×`size` điểm ảnh (uint8).
+        Ảnh lưu/nén/thu nhỏ lại cho lưới gần như trùng khớp; hai phiếu cùng bố cục nhưng khác số
+        vẫn lệch rõ ở vùng chữ số (khác với dHash 64 bit, vốn cho hai phiếu như vậy cùng một hash).
+        """
+        digest = content_digest(image_bytes)
+        with self._lock:
+            cached = self._fingerprints.get((digest, size))
+            if cached is not None:
+                return cached
+
+        small = self._decode(digest, image_bytes).convert("L").resize((size, size), Image.LANCZOS)
+        value = small.tobytes()
+
+        with self._lock:
+            self._fingerprints[(digest, size)] = value
+            while len(self._fingerprints) > self.max_entries:
+                self._fingerprints.popitem(last=False)
+        return value
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "entries": len(self._prepared),
+                "decoded_entries": len(self._decoded),
+                "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+                "compression_ratio": self._stats["bytes_out"] / self._stats["bytes_in"] if self._stats["bytes_in"] else 0.0,
+            }
+
+    def _decode(self, digest: str, image_bytes: bytes) -> Image.Image:
+        with self._lock:
+            image = self._decoded.get(digest)
+            if image is not None:
+                self._decoded.move_to_end(digest)
+                return image
+
+        image = Image.open(io.BytesIO(image_bytes))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            # JPEG không có kênh alpha: đặt lên nền trắng để chữ trên ảnh trong suốt vẫn đọc được
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        else:
+            image = image.convert("RGB")
+        image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+
+        with self._lock:
+            self._stats["decodes"] += 1
+            self._decoded[digest] = image
+            while len(self._decoded) > self.max_decoded:
+                self._decoded.popitem(last=False)
+        return image
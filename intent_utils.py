@@ -0,0 +1,103 @@
+import numpy as np
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Các câu mẫu cho từng intent, dùng để tính centroid embedding.
+# Giữ đồng bộ với các định nghĩa trong intent_template của app.py.
+INTENT_EXAMPLES: Dict[str, List[str]] = {
+    "greeting_social": [
+        "Chào bạn",
+        "Xin chào gia sư",
+        "Hello, mình mới vào",
+        "Cảm ơn bạn nhiều nhé",
+        "Cảm ơn, mình hiểu rồi",
+        "Tạm biệt, hẹn gặp lại",
+        "Bạn là ai vậy?",
+        "Chúc bạn một ngày tốt lành",
+    ],
+    "math_question": [
+        "Giải giúp mình phương trình x^2 + 5x - 6 = 0",
+        "Giải phương trình x + 5 = 10",
+        "Hệ thức Vi-ét dùng để làm gì?",
+        "Tính diện tích hình tròn bán kính 3cm",
+        "Giải hệ phương trình 2x + y = 5 và x - y = 1",
+        "Rút gọn biểu thức căn 12 cộng căn 27",
+        "Giải bất phương trình 2x - 3 > 5",
+        "Chứng minh định lý Pythagore",
+        "Công thức tính delta của phương trình bậc hai là gì?",
+        "Tỉ số lượng giác của góc nhọn là gì?",
+    ],
+    "request_for_practice": [
+        "Có bài nào tương tự để mình luyện tập thêm không?",
+        "Cho tôi bài tập về phương trình",
+        "Tôi muốn luyện tập thêm",
+        "Ra cho mình vài bài tập về hệ phương trình",
+        "Mình muốn làm thêm bài tập để ôn thi",
+        "Cho mình đề luyện tập về căn thức",
+    ],
+    "expression_of_stress": [
+        "Bài này khó quá, mình nản thật",
+        "Tôi mệt quá",
+        "Khó hiểu quá",
+        "Không làm được",
+        "Mình học mãi không vào, chán quá",
+        "Sắp thi rồi mà mình lo lắng quá",
+        "Mình thấy mình dốt toán quá",
+    ],
+    "study_support": [
+        "Làm sao để học tốt môn hình học không gian?",
+        "Có phương pháp nào để học toán hiệu quả không?",
+        "Mình nên ôn thi vào lớp 10 như thế nào?",
+        "Làm sao để có động lực học toán?",
+        "Mỗi ngày nên học toán bao nhiêu tiếng?",
+        "Bạn có thể giúp mình những gì?",
+    ],
+    "off_topic": [
+        "Giá vàng hôm nay bao nhiêu?",
+        "Thời tiết ngày mai thế nào?",
+        "Kể cho mình một câu chuyện cười",
+        "Đội bóng nào vô địch World Cup?",
+        "Gợi ý cho mình một bộ phim hay",
+        "Cách nấu phở bò",
+    ],
+}
+
+
+class CentroidIntentClassifier:
+    """
+    Phân loại ý định cục bộ bằng nearest-centroid trên embedding của vietnamese-bi-encoder.
+    Chỉ trả về nhãn khi đủ tự tin; ngược lại để LLM quyết định.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[str], Sequence[float]],
+        examples: Dict[str, List[str]] = INTENT_EXAMPLES,
+        min_similarity: float = 0.55,
+        min_margin: float = 0.08,
+    ):
+        self.embed_fn = embed_fn
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+        self.labels = list(examples.keys())
+
+        centroids = []
+        for label in self.labels:
+            vectors = _normalize(np.array([embed_fn(text) for text in examples[label]], dtype=np.float32))
+            centroids.append(vectors.mean(axis=0))
+        self.centroids = _normalize(np.stack(centroids))
+
+    def predict(self, text: str) -> Tuple[str, float, float]:
+        """Trả về (nhãn gần nhất, cosine với centroid đó, khoảng cách tới nhãn thứ hai)."""
+        query = _normalize(np.asarray(self.embed_fn(text), dtype=np.float32)[None, :])[0]
+        similarities = self.centroids @ query
+        order = np.argsort(similarities)[::-1]
+        best, second = order[0], order[1]
+        return self.labels[best], float(similarities[best]), float(similarities[best] - similarities[second])
+
+    def is_confident(self, similarity: float, margin: float) -> bool:
+        return similarity >= self.min_similarity and margin >= self.min_margin
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
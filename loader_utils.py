@@ -0,0 +1,95 @@
+import time
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+PENDING = "pending"
+LOADING = "loading"
+READY = "ready"
+FAILED = "failed"
+
+
+class _Entry:
+    def __init__(self, loader: Callable[[], Any]):
+        self.loader = loader
+        self.status = PENDING
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+        self.started_at: Optional[float] = None
+        self.load_seconds: Optional[float] = None
+        self.done = threading.Event()
+
+
+class ModelRegistry:
+    """
+    Sổ đăng ký các model nặng được nạp trong thread nền.
+    Giao diện có thể hỏi trạng thái (pending/loading/ready/failed) mà không bị chặn,
+    hoặc chờ một model bằng `get` khi thực sự cần dùng.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, loader: Callable[[], Any]):
+        with self._lock:
+            self._entries[name] = _Entry(loader)
+
+    def start(self, name: str, after: Iterable[str] = ()):
+        """
+        Bắt đầu nạp `name` trong nền (không làm gì nếu đã bắt đầu).
+        `after`: chờ các model này nạp xong (thành công hay thất bại) trước, để không tranh CPU.
+        """
+        with self._lock:
+            entry = self._entries[name]
+            if entry.status != PENDING:
+                return
+            entry.status = LOADING
+            entry.started_at = time.time()
+
+        after = list(after)
+        threading.Thread(target=self._load, args=(name, entry, after), name=f"load-{name}", daemon=True).start()
+
+    def _load(self, name: str, entry: _Entry, after: Iterable[str]):
+        for dependency in after:
+            self._entries[dependency].done.wait()
+
+        print(f"DEBUG: [Model Registry] Loading '{name}'...")
+        start = time.perf_counter()
+        try:
+            entry.value = entry.loader()
+            entry.status = READY
+            print(f"DEBUG: [Model Registry] '{name}' ready after {time.perf_counter() - start:.1f}s")
+        except Exception as e:
+            entry.error = e
+            entry.status = FAILED
+            print(f"ERROR: [Model Registry] Loading '{name}' failed: {e}")
+        finally:
+            entry.load_seconds = time.perf_counter() - start
+            entry.done.set()
+
+    def status(self, name: str) -> str:
+        return self._entries[name].status
+
+    def is_ready(self, name: str) -> bool:
+        return name in self._entries and self._entries[name].status == READY
+
+    def get(self, name: str, timeout: Optional[float] = None) -> Any:
+        """Trả về model, bắt đầu nạp ngay nếu chưa ai yêu cầu và chờ tới khi sẵn sàng."""
+        entry = self._entries[name]
+        if entry.status == PENDING:
+            self.start(name)
+        if not entry.done.wait(timeout):
+            raise TimeoutError(f"Model '{name}' chưa sẵn sàng sau {timeout}s")
+        if entry.status == FAILED:
+            raise RuntimeError(f"Không thể nạp model '{name}': {entry.error}")
+        return entry.value
+
+    def statuses(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {
+                "status": entry.status,
+                "load_seconds": round(entry.load_seconds, 2) if entry.load_seconds is not None else None,
+                "error": str(entry.error) if entry.error else None,
+            }
+            for name, entry in self._entries.items()
+        }
@@ -0,0 +1,754 @@
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import sympy
+from sympy.parsing.sympy_parser import (
+    convert_xor,
+    implicit_multiplication_application,
+    parse_expr,
+    rationalize,
+    standard_transformations,
+)
+
+EQUATION = "equation"
+SYSTEM = "system"
+INEQUALITY = "inequality"
+RADICAL = "radical"
+
+# rationalize: số thập phân (2,5 hay 2.5) thành phân số để kết quả chính xác (x = 2 thay vì x = 2.0)
+TRANSFORMATIONS = standard_transformations + (implicit_multiplication_application, convert_xor, rationalize)
+# Giá trị không xác định (1/0), vô cực hay số phức (căn của số âm) không thuộc chương trình lớp 9
+UNDEFINED_VALUES = (sympy.zoo, sympy.nan, sympy.oo, -sympy.oo, sympy.I)
+VARIABLES = {name: sympy.Symbol(name, real=True) for name in "xyzt"}
+PARSE_NAMESPACE = {**VARIABLES, "sqrt": sympy.sqrt}
+# parse_expr sinh mã gọi các lớp này (Integer(2), Rational(...)), không cho dùng gì khác
+PARSE_GLOBALS = {"__builtins__": {}, **{name: getattr(sympy, name) for name in ("Integer", "Float", "Rational", "Symbol", "Add", "Mul", "Pow")}}
+
+# Chỉ cho phép biểu thức ngắn gồm số, biến x/y/z/t, sqrt và các phép toán cơ bản trước khi đưa vào parse_expr (dùng eval)
+SAFE_EXPRESSION = re.compile(r"^(?:sqrt|[xyzt0-9.+\-*/^()\s])+$")
+# Số mũ chỉ là một chữ số, không lồng nhau (9^9^9 sẽ làm treo tiến trình khi sympy tính)
+SAFE_EXPONENT = re.compile(r"\^\s*(?:\d|\(\s*\d\s*\))(?![\d.])")
+CHAINED_EXPONENT = re.compile(r"\^\s*\(?\s*\d\s*\)?\s*\^")
+MAX_EXPONENTS = 3
+MAX_EXPRESSION_LENGTH = 200
+
+RELATION = re.compile(r"(<=|>=|!=|=|<|>)")
+RELATIONS = {
+    "=": sympy.Eq,
+    "<": sympy.StrictLessThan,
+    ">": sympy.StrictGreaterThan,
+    "<=": sympy.LessThan,
+    ">=": sympy.GreaterThan,
+}
+
+CONCLUSION_MARKERS = re.compile(r"vậy|kết luận|đáp án|đáp số|kết quả|tập nghiệm|(?-i:\bS\s*=)", re.IGNORECASE)
+# Từ không dấu thường gặp đứng ngay trước công thức mà không đổi nghĩa của nó ("giải pt x^2 = 4", "phương trình sau:")
+TOUCHING_WORDS_ALLOWED = {"sau", "cho", "pt", "bpt", "hpt"}
+# Toàn bộ phần chữ của một đề rút gọn/tính biểu thức số: "Rút gọn biểu thức A =", "Tính giá trị của biểu thức:"...
+RADICAL_REQUEST = re.compile(
+    r"^(?:hãy\s+)?(?:rút gọn|thu gọn|tính)(?:\s+giá trị)?(?:\s+của)?(?:\s+biểu thức)?(?:\s+sau)?\s*:?\s*(?:[a-z]\s*=?)?\s*[:.]?$"
+)
+# Đề giới hạn tập nghiệm hoặc yêu cầu thêm việc khác ngoài giải/tính: đáp số không còn là tập nghiệm thực thông thường
+RESTRICTING_WORDS = re.compile(
+    r"\b(?:nguyên|tự nhiên|hữu tỉ|vô tỉ|dương|âm|tại|khi|rồi|sau đó|tổng|tích|hiệu|thương|điều kiện|thỏa mãn|thoả mãn"
+    r"|sao cho|lớn nhất|nhỏ nhất|thuộc|tham số|chia hết)\b|∈|\\in\b|\\mathbb",
+    re.IGNORECASE,
+)
+NO_SOLUTION = re.compile(r"vô\s+nghiệm", re.IGNORECASE)
+INFINITE_SOLUTIONS = re.compile(r"vô\s+số\s+nghiệm", re.IGNORECASE)
+
+LATEX_REPLACEMENTS = [
+    (r"\\left|\\right|\\displaystyle", ""),
+    (r"\\text\s*\{[^{}]*\}|\\mathrm\s*\{[^{}]*\}", " "),
+    (r"\\quad\s*\(\s*\d+\s*\)|\\qquad|\\quad|\\,|\\;|\\!", " "),
+    (r"\\[dt]frac", r"\\frac"),
+    (r"\\cdot|\\times", "*"),
+    (r"\\div", "/"),
+    (r"\\leqslant|\\leq|\\le\b", "<="),
+    (r"\\geqslant|\\geq|\\ge\b", ">="),
+    (r"\\neq|\\ne\b", "!="),
+    (r"\\mid", "|"),
+    (r"\\pm", "±"),
+    (r"\\([{}])", r"\1"),
+    (r"_\s*\{[^{}]*\}|_\s*\d", ""),
+]
+UNICODE_REPLACEMENTS = [
+    ("−", "-"), ("–", "-"), ("×", "*"), ("·", "*"), ("⋅", "*"), ("÷", "/"),
+    ("≤", "<="), ("≥", ">="), ("≠", "!="), ("²", "^2"), ("³", "^3"),
+    ("₁", ""), ("₂", ""), ("**", "^"),
+]
+
+
+class MathProblem:
+    """Một bài toán lớp 9 đã nhận dạng: loại bài, các biểu thức sympy và biến."""
+
+    def __init__(self, kind: str, expressions: List[Any], variables: List[sympy.Symbol], statement: str):
+        self.kind = kind
+        self.expressions = expressions
+        self.variables = variables
+        self.statement = statement
+
+    def solve(self) -> Any:
+        """
+        Tập nghiệm (phương trình, bất phương trình, hệ) hoặc giá trị đã rút gọn (biểu thức căn).
+        Ném ValueError nếu kết quả không xác định hoặc không phải số thực.
+        """
+        if self.kind == EQUATION or self.kind == INEQUALITY:
+            return sympy.solveset(self.expressions[0], self.variables[0], domain=sympy.S.Reals)
+        if self.kind == SYSTEM:
+            return sympy.linsolve([eq.lhs - eq.rhs for eq in self.expressions], self.variables)
+        value = sympy.radsimp(sympy.nsimplify(sympy.sqrtdenest(self.expressions[0])))
+        if value.has(*UNDEFINED_VALUES) or value.is_real is not True:
+            raise ValueError(f"Giá trị không phải số thực xác định: {value}")
+        return value
+
+
+def _replace_braced(text: str, command: str, arity: int, template: str) -> str:
+    """Thay `\\command{a}{b}` (ngoặc lồng nhau được) bằng template.format(a, b)."""
+    while True:
+        start = text.find(command + "{")
+        if start < 0:
+            return text
+        position = start + len(command)
+        arguments = []
+        for _ in range(arity):
+            while position < len(text) and text[position] == " ":
+                position += 1
+            if position >= len(text) or text[position] != "{":
+                return text
+            depth, end = 0, position
+            for end in range(position, len(text)):
+                depth += {"{": 1, "}": -1}.get(text[end], 0)
+                if depth == 0:
+                    break
+            arguments.append(text[position + 1:end])
+            position = end + 1
+        text = text[:start] + template.format(*arguments) + text[position:]
+
+
+def to_plain(text: str) -> str:
+    """Chuyển biểu thức LaTeX/Unicode sang cú pháp gần với sympy (sqrt, ^, /)."""
+    for source, target in UNICODE_REPLACEMENTS:
+        text = text.replace(source, target)
+    for pattern, replacement in LATEX_REPLACEMENTS:
+        text = re.sub(pattern, replacement, text)
+    text = _replace_braced(text, "\\frac", 2, "(({0})/({1}))")
+    text = _replace_braced(text, "\\sqrt", 1, "sqrt({0})")
+    text = re.sub(r"\\sqrt\s*(\d+|[a-z])", r"sqrt(\1)", text)
+    text = re.sub(r"√\s*\(", "sqrt(", text)
+    text = re.sub(r"√\s*(\d+(?:\.\d+)?|[a-z])", r"sqrt(\1)", text)
+    text = text.replace("{", "(").replace("}", ")")
+    # Dấu phẩy thập phân kiểu Việt Nam: 2,5 -> 2.5
+    return re.sub(r"(?<=\d),(?=\d)", ".", text)
+
+
+def parse_expression(text: str, evaluate: bool = True) -> Optional[sympy.Expr]:
+    """
+    Parse một biểu thức đã qua `to_plain`; trả về None nếu không an toàn hoặc không parse được.
+    `evaluate=False` giữ nguyên dạng viết trong đề (để hiển thị lại trong lời giải).
+    """
+    text = text.strip()
+    if not text or len(text) > MAX_EXPRESSION_LENGTH or not SAFE_EXPRESSION.match(text):
+        return None
+    exponents = text.count("^")
+    if exponents > MAX_EXPONENTS or exponents != len(SAFE_EXPONENT.findall(text)) or CHAINED_EXPONENT.search(text):
+        return None
+    try:
+        expression = parse_expr(text, local_dict=dict(PARSE_NAMESPACE), global_dict=dict(PARSE_GLOBALS), transformations=TRANSFORMATIONS, evaluate=evaluate)
+    except Exception:
+        return None
+    return expression if isinstance(expression, sympy.Expr) else None
+
+
+def parse_relation(text: str) -> Optional[Any]:
+    """Parse `lhs <op> rhs` (đúng một dấu quan hệ) thành quan hệ sympy."""
+    parts = RELATION.split(text)
+    if len(parts) != 3 or parts[1] == "!=":
+        return None
+    lhs, rhs = parse_expression(parts[0]), parse_expression(parts[2])
+    if lhs is None or rhs is None:
+        return None
+    return RELATIONS[parts[1]](lhs, rhs, evaluate=False)
+
+
+DELIMITED_MATH = re.compile(r"\$\$(.+?)\$\$|\$(.+?)\$|\\\((.+?)\\\)|\\\[(.+?)\\\]", re.DOTALL)
+
+
+def _is_math_token(token: str) -> bool:
+    plain = to_plain(token)
+    letters = re.sub(r"sqrt", "", plain)
+    return bool(token) and bool(re.fullmatch(r"[0-9a-z.+\-*/^()=<>!±√\\{}\[\]\s]+", plain)) and not re.search(r"[a-z]{2}", letters)
+
+
+def math_segments(text: str) -> List[str]:
+    """
+    Các đoạn công thức trong văn bản: nội dung $...$, \\(...\\), \\[...\\] nếu có,
+    nếu không thì các chuỗi token chỉ gồm số, biến và phép toán (văn bản gõ tay, kết quả OCR).
+    """
+    delimited = DELIMITED_MATH.findall(text)
+    if delimited:
+        return [next(group for group in groups if group) for groups in delimited]
+
+    segments = []
+    for line in text.splitlines():
+        current: List[str] = []
+        for token in line.split():
+            stripped = token.rstrip(".,;:?!")
+            is_math = _is_math_token(stripped)
+            if is_math:
+                current.append(stripped)
+            if current and (not is_math or stripped != token):
+                segments.append(" ".join(current))
+                current = []
+        if current:
+            segments.append(" ".join(current))
+    return segments
+
+
+def _prose(text: str) -> str:
+    """Phần văn bản ngoài các đoạn công thức (cùng cách tách với `math_segments`), chữ thường."""
+    if DELIMITED_MATH.search(text):
+        prose = DELIMITED_MATH.sub(" ", text)
+    else:
+        prose = " ".join(token for token in text.split() if not _is_math_token(token.rstrip(".,;:?!")))
+    return " ".join(prose.lower().split())
+
+
+def _touches_word(text: str) -> bool:
+    """
+    Có từ chữ Latin (sin, cos, log, cm, kg...) đứng sát một đoạn công thức hay không. `math_segments` bỏ các từ này đi,
+    nên "sin 30 + √4" hay "cạnh √3 cm" sẽ bị đọc thành một biểu thức khác hẳn đề bài.
+    """
+    def is_word(token: str) -> bool:
+        word = token.strip(".,;:?!()").lower()
+        return bool(re.fullmatch(r"[a-z]{2,}", word)) and word not in TOUCHING_WORDS_ALLOWED
+
+    if DELIMITED_MATH.search(text):
+        for match in DELIMITED_MATH.finditer(text):
+            before, after = text[:match.start()].split(), text[match.end():].split()
+            if (before and is_word(before[-1])) or (after and is_word(after[0])):
+                return True
+        return False
+
+    for line in text.splitlines():
+        tokens = line.split()
+        flags = [_is_math_token(token.rstrip(".,;:?!")) for token in tokens]
+        for index, token in enumerate(tokens):
+            neighbours = flags[max(index - 1, 0):index] + flags[index + 1:index + 2]
+            if not flags[index] and any(neighbours) and is_word(token):
+                return True
+    return False
+
+
+def _pieces(segment: str) -> List[str]:
+    """Tách một đoạn công thức thành các mệnh đề: theo dòng của cases, dấu ; và dấu , ở mức ngoài cùng."""
+    segment = re.sub(r"\\begin\s*\{cases\}|\\end\s*\{cases\}", "", segment)
+    pieces = []
+    for part in re.split(r"\\\\|\n", segment):
+        pieces.extend(_split_top_level(to_plain(part), ";,"))
+    return [piece.strip() for piece in pieces if piece.strip()]
+
+
+def _split_top_level(text: str, separators: str) -> List[str]:
+    parts, depth, current = [], 0, ""
+    for char in text:
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        if char in separators and depth == 0:
+            parts.append(current)
+            current = ""
+        else:
+            current += char
+    parts.append(current)
+    return parts
+
+
+def parse_problem(text: str) -> Optional[MathProblem]:
+    """
+    Nhận dạng một bài toán thuộc các dạng: phương trình bậc nhất/bậc hai một ẩn, hệ hai phương trình
+    bậc nhất hai ẩn, bất phương trình bậc nhất một ẩn, rút gọn/tính biểu thức số chứa căn.
+    Trả về None nếu đề có nhiều câu hỏi, chứa tham số, giới hạn tập nghiệm ("nghiệm nguyên", "số tự nhiên"...),
+    yêu cầu thêm ("rồi tính tổng hai nghiệm"...) hay dạng khác (để dùng verifier LLM).
+    """
+    if RESTRICTING_WORDS.search(text) or _touches_word(text):
+        return None
+    lowered = text.lower()
+    equations, inequalities, expressions = [], [], []
+    for segment in math_segments(text):
+        for piece in _pieces(segment):
+            named = re.match(r"^\s*[A-Z]\s*=\s*(.+)$", piece)
+            if named:
+                piece = named.group(1)
+            # Mọi đoạn công thức đều phải đọc được: đoạn bị bỏ qua có thể là điều kiện hay yêu cầu khác của đề
+            if RELATION.search(piece):
+                relation = parse_relation(piece)
+                if relation is None or relation.has(*UNDEFINED_VALUES):
+                    return None
+                (equations if isinstance(relation, sympy.Eq) else inequalities).append(relation)
+            elif piece.strip() not in VARIABLES:  # "Tìm x biết ...": tên ẩn đứng riêng
+                expression = parse_expression(piece)
+                # Biểu thức còn chứa biến (tính giá trị tại x = ..., rút gọn biểu thức chữ) không thuộc các dạng trên
+                if expression is None or expression.free_symbols or expression.has(*UNDEFINED_VALUES):
+                    return None
+                if "sqrt" in piece:
+                    expressions.append(expression)
+
+    if len(equations) == 2 and not inequalities:
+        variables = sorted(set().union(*(eq.free_symbols for eq in equations)), key=str)
+        if len(variables) == 2 and all(_degree(eq, variables) == 1 for eq in equations):
+            return MathProblem(SYSTEM, equations, variables, text)
+        return None
+
+    if len(equations) == 1 and not inequalities and "hệ" not in lowered:
+        variables = list(equations[0].free_symbols)
+        if len(variables) == 1 and _degree(equations[0], variables) in (1, 2):
+            return MathProblem(EQUATION, equations, variables, text)
+        return None
+
+    if len(inequalities) == 1 and not equations:
+        variables = list(inequalities[0].free_symbols)
+        if len(variables) == 1 and _degree(inequalities[0], variables) == 1:
+            return MathProblem(INEQUALITY, inequalities, variables, text)
+        return None
+
+    # Chỉ nhận "rút gọn/tính biểu thức" khi ngoài công thức không còn gì khác: "tính chu vi hình vuông cạnh √3"
+    # cũng có đúng một hằng số chứa căn nhưng đáp số không phải giá trị của hằng số đó
+    if not equations and not inequalities and len(expressions) == 1 and RADICAL_REQUEST.match(_prose(text)):
+        return MathProblem(RADICAL, expressions, [], text)
+    return None
+
+
+def _degree(relation: Any, variables: List[sympy.Symbol]) -> Optional[int]:
+    try:
+        return sympy.Poly(sympy.expand(relation.lhs - relation.rhs), *variables).total_degree()
+    except sympy.PolynomialError:
+        return None
+
+
+def _conclusions(answer: str) -> List[str]:
+    """
+    Các khối kết luận của lời giải: từ mỗi "Vậy"/"Kết luận"/"Đáp án"/"S = "... tới dấu kết luận tiếp theo.
+    Dấu nằm trong công thức ($S = ...$) thì khối bắt đầu từ dấu $ mở công thức đó.
+    """
+    starts = []
+    for match in CONCLUSION_MARKERS.finditer(answer):
+        start = match.start()
+        if answer.count("$", 0, start) % 2:
+            start = answer.rfind("$", 0, start)
+        if not starts or start > starts[-1]:
+            starts.append(start)
+    return [answer[start:end] for start, end in zip(starts, starts[1:] + [len(answer)])]
+
+
+def _constant(text: str) -> Optional[sympy.Expr]:
+    expression = parse_expression(text)
+    if expression is None or expression.free_symbols:
+        return None
+    return expression
+
+
+# Đoạn văn có nêu đáp số nhưng không đọc được hết (ví dụ một nghiệm chứa ký hiệu lạ)
+INCOMPLETE = object()
+
+
+def extract_claim(problem: MathProblem, text: str) -> Any:
+    """
+    Đáp số mà đoạn `text` khẳng định, cùng dạng với `MathProblem.solve()`.
+    Trả về None nếu đoạn không nêu đáp số, INCOMPLETE nếu có nêu nhưng không đọc được trọn vẹn.
+    """
+    segments = math_segments(text)
+    plain = [to_plain(re.sub(r"\\begin\s*\{cases\}|\\end\s*\{cases\}|\\\\", ";", segment)) for segment in segments]
+
+    if problem.kind == RADICAL:
+        for segment in reversed(plain):
+            value = _constant(segment.split("=")[-1])
+            if value is not None:
+                return value
+        return None
+
+    if INFINITE_SOLUTIONS.search(text):
+        return "infinite" if problem.kind == SYSTEM else sympy.S.Reals
+    if NO_SOLUTION.search(text) or any(re.search(r"\\varnothing|\\emptyset|∅", segment) for segment in segments):
+        return sympy.S.EmptySet
+
+    if problem.kind == INEQUALITY:
+        variable = problem.variables[0]
+        mention = re.compile(r"(?<![a-z])%s(?![a-z])" % variable)
+        for segment in reversed(plain):
+            for piece in re.split(r"[;,|]", segment):
+                # Bỏ ngoặc thừa của cách viết tập hợp {x | x > 3}
+                relation = parse_relation(piece)
+                if relation is None:
+                    relation = parse_relation(piece.strip(" ()"))
+                if relation is None:
+                    if mention.search(piece) and re.search(r"[<>]", piece):
+                        return INCOMPLETE
+                    continue
+                if relation.free_symbols == {variable} and not isinstance(relation, sympy.Eq):
+                    if variable in (relation.lhs, relation.rhs):
+                        return relation.as_set()
+        return None
+
+    compact = [segment.replace(" ", "") for segment in plain]
+    if problem.kind == SYSTEM:
+        names = [str(variable) for variable in problem.variables]
+        for segment in compact:
+            pair = re.search(r"\(%s[;,]%s\)=\((.+)\)" % tuple(names), segment)
+            if pair:
+                values = [_constant(value) for value in _split_top_level(pair.group(1), ";,")]
+                if len(values) == 2 and None not in values:
+                    return sympy.FiniteSet(tuple(values))
+                return INCOMPLETE
+        assignments, incomplete = _assignments(compact, names)
+        if incomplete:
+            return INCOMPLETE
+        if all(len(assignments[name]) == 1 for name in names):
+            return sympy.FiniteSet(tuple(assignments[name][0] for name in names))
+        return INCOMPLETE if any(assignments.values()) else None
+
+    name = str(problem.variables[0])
+    for segment in compact:
+        solution_set = re.search(r"S=\((.*)\)", segment)
+        if solution_set:
+            values = [_constant(value) for value in _split_top_level(solution_set.group(1), ";,")]
+            if values and None not in values:
+                return sympy.FiniteSet(*values)
+            return INCOMPLETE
+    assignments, incomplete = _assignments(compact, [name])
+    if incomplete:
+        return INCOMPLETE
+    if assignments[name]:
+        return sympy.FiniteSet(*assignments[name])
+    return None
+
+
+def _assignments(segments: List[str], names: List[str]) -> Tuple[Dict[str, List[sympy.Expr]], bool]:
+    """
+    Các giá trị dạng `x = ...` (cả chuỗi `x = x = 3` của nghiệm kép) trong các đoạn công thức,
+    kèm cờ có phép gán nào mà vế phải không đọc được hay không.
+    """
+    assignments: Dict[str, List[sympy.Expr]] = {name: [] for name in names}
+    incomplete = False
+    for segment in segments:
+        for piece in _split_top_level(segment, ";,"):
+            parts = piece.split("=")
+            if len(parts) < 2 or any(part not in names for part in parts[:-1]) or len(set(parts[:-1])) != 1:
+                continue
+            # x = ±a là hai nghiệm a và -a
+            signs = (1, -1) if parts[-1].startswith("±") else (1,)
+            value = _constant(parts[-1].lstrip("±"))
+            if value is None:
+                incomplete = True
+                continue
+            for sign in signs:
+                if sign * value not in assignments[parts[0]]:
+                    assignments[parts[0]].append(sign * value)
+    return assignments, incomplete
+
+
+def _same(problem: MathProblem, claimed: Any, expected: Any) -> bool:
+    if problem.kind == RADICAL:
+        difference = sympy.simplify(claimed - expected)
+        return difference == 0 or abs(float(sympy.N(difference))) < 1e-9
+    if problem.kind == SYSTEM:
+        # linsolve biểu diễn vô số nghiệm bằng nghiệm chứa tham số, ví dụ {(x, 3x + 4)}
+        expected_infinite = any(value.free_symbols for solution in expected for value in solution)
+        if claimed == "infinite" or expected_infinite:
+            return claimed == "infinite" and expected_infinite
+    if problem.kind == SYSTEM and isinstance(claimed, sympy.FiniteSet):
+        return len(expected) == len(claimed) and all(
+            any(all(sympy.simplify(a - b) == 0 for a, b in zip(solution, claim)) for claim in claimed) for solution in expected
+        )
+    if isinstance(expected, sympy.FiniteSet) and isinstance(claimed, sympy.FiniteSet):
+        return len(expected) == len(claimed) and all(
+            any(sympy.simplify(solution - claim) == 0 for claim in claimed) for solution in expected
+        )
+    return bool(expected == claimed or sympy.simplify(expected.symmetric_difference(claimed)) == sympy.S.EmptySet)
+
+
+def format_solution(problem: MathProblem, solution: Any) -> str:
+    """Đáp số viết bằng tiếng Việt, công thức dạng LaTeX ($...$) để hiển thị trong khung chat."""
+    if problem.kind == RADICAL:
+        return f"biểu thức có giá trị ${sympy.latex(solution)}$"
+
+    if problem.kind == SYSTEM:
+        if solution == sympy.S.EmptySet:
+            return "hệ phương trình vô nghiệm"
+        if not isinstance(solution, sympy.FiniteSet) or any(value.free_symbols for value in next(iter(solution))):
+            return "hệ phương trình có vô số nghiệm"
+        x_value, y_value = next(iter(solution))
+        names = "; ".join(str(variable) for variable in problem.variables)
+        return f"hệ phương trình có nghiệm $({names}) = ({sympy.latex(x_value)}; {sympy.latex(y_value)})$"
+
+    variable = problem.variables[0]
+    if problem.kind == INEQUALITY:
+        if solution == sympy.S.EmptySet:
+            return "bất phương trình vô nghiệm"
+        if solution == sympy.S.Reals:
+            return "bất phương trình nghiệm đúng với mọi $x$"
+        return f"nghiệm của bất phương trình là ${_interval_latex(solution, variable)}$"
+
+    if solution == sympy.S.EmptySet:
+        return "phương trình vô nghiệm"
+    if solution == sympy.S.Reals:
+        return "phương trình có vô số nghiệm"
+    values = sorted(solution, key=lambda value: float(sympy.N(value)))
+    if len(values) == 1:
+        return f"phương trình có nghiệm ${variable} = {sympy.latex(values[0])}$"
+    joined = " và ".join(f"${variable} = {sympy.latex(value)}$" for value in values)
+    return f"phương trình có hai nghiệm {joined}"
+
+
+def _interval_latex(solution: Any, variable: sympy.Symbol) -> str:
+    if isinstance(solution, sympy.Interval) and solution.start == -sympy.oo:
+        operator = "<" if solution.right_open else r"\le"
+        return f"{variable} {operator} {sympy.latex(solution.end)}"
+    if isinstance(solution, sympy.Interval) and solution.end == sympy.oo:
+        operator = ">" if solution.left_open else r"\ge"
+        return f"{variable} {operator} {sympy.latex(solution.start)}"
+    return sympy.latex(solution.as_relational(variable))
+
+
+def verify_solution(problem_text: str, answer: str) -> Optional[Dict[str, Any]]:
+    """
+    Kiểm tra đáp số của lời giải bằng sympy cho các dạng bài nhận dạng được.
+    Trả về kết quả cùng định dạng với verifier LLM (`is_correct`, `correction_suggestion`) hoặc None
+    nếu không đọc được đề/đáp số. Mọi khối kết luận ("Vậy ...", "Đáp số: ...") đều được đọc: chỉ kết luận "đúng"
+    khi tất cả khớp và chỉ kết luận "sai" khi tất cả cùng lệch; các trường hợp lẫn lộn để verifier LLM quyết định.
+    """
+    try:
+        problem = parse_problem(problem_text)
+        if problem is None:
+            return None
+        blocks = _conclusions(answer)
+        claims = [extract_claim(problem, block) for block in blocks or [answer[-400:]]]
+        if any(claim is INCOMPLETE for claim in claims):
+            return None
+        claims = [claim for claim in claims if claim is not None]
+        if not claims:
+            return None
+
+        expected = problem.solve()
+        matches = [_same(problem, claim, expected) for claim in claims]
+        if all(matches):
+            return {"is_correct": True, "correction_suggestion": "", "verifier": "sympy", "problem_type": problem.kind}
+        if any(matches) or not blocks:
+            return None
+        return {
+            "is_correct": False,
+            "correction_suggestion": f"Kiểm tra lại bằng tính toán chính xác thì {format_solution(problem, expected)}.",
+            "verifier": "sympy",
+            "problem_type": problem.kind,
+        }
+    except Exception as e:
+        print(f"DEBUG: [Math Verifier] Could not verify symbolically: {e}")
+        return None
+
+
+FAST_PATH_REQUEST = re.compile(r"^\s*(?:hãy\s+)?(?:giải(?!\s+thích)|tìm|tính|rút gọn|thu gọn)", re.IGNORECASE)
+# Đề yêu cầu phương pháp cụ thể hoặc lời giải thích: để Gemini trả lời
+FAST_PATH_EXCLUDED = re.compile(
+    r"giải thích|tại sao|vì sao|chứng minh|hướng dẫn|bằng cách|theo cách|phương pháp|nhân tử|đồ thị|biện luận|\?",
+    re.IGNORECASE,
+)
+FAST_PATH_MAX_LENGTH = 160
+INEQUALITY_SIGNS = {"<": "<", "<=": r"\le", ">": ">", ">=": r"\ge"}
+FLIPPED_SIGNS = {"<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+
+def _linear_terms(relation: Any, variables: List[sympy.Symbol]) -> Tuple[List[sympy.Expr], sympy.Expr]:
+    """Hệ số của từng biến và vế phải sau khi chuyển vế: a1*x + a2*y + ... (quan hệ) c."""
+    expression = sympy.expand(relation.lhs - relation.rhs)
+    coefficients = [expression.coeff(variable) for variable in variables]
+    constant = expression.subs({variable: 0 for variable in variables})
+    return coefficients, -constant
+
+
+def _linear_steps(problem: MathProblem, solution: Any) -> Optional[List[str]]:
+    variable = problem.variables[0]
+    (a,), c = _linear_terms(problem.expressions[0], problem.variables)
+    steps = [f"Chuyển các hạng tử chứa ${variable}$ sang vế trái, hằng số sang vế phải rồi thu gọn: ${sympy.latex(a * variable)} = {sympy.latex(c)}$."]
+    if a != 1:
+        steps.append(f"Chia hai vế cho ${sympy.latex(a)}$: ${variable} = {sympy.latex(c / a)}$.")
+    return steps
+
+
+def _quadratic_steps(problem: MathProblem, solution: Any) -> Optional[List[str]]:
+    variable = problem.variables[0]
+    expression = sympy.expand(problem.expressions[0].lhs - problem.expressions[0].rhs)
+    a, b, c = sympy.Poly(expression, variable).all_coeffs()
+    delta = sympy.simplify(b ** 2 - 4 * a * c)
+    steps = [
+        f"Đưa phương trình về dạng $a{variable}^2 + b{variable} + c = 0$: ${sympy.latex(expression)} = 0$, "
+        f"với $a = {sympy.latex(a)}$, $b = {sympy.latex(b)}$, $c = {sympy.latex(c)}$.",
+        f"Tính biệt thức: $\\Delta = b^2 - 4ac = {sympy.latex(delta)}$.",
+    ]
+    if delta.is_negative:
+        steps.append("Vì $\\Delta < 0$ nên phương trình vô nghiệm.")
+    elif delta.is_zero:
+        steps.append(f"Vì $\\Delta = 0$ nên phương trình có nghiệm kép ${variable} = -\\frac{{b}}{{2a}} = {sympy.latex(-b / (2 * a))}$.")
+    elif delta.is_positive:
+        roots = ", ".join(
+            f"{variable}_{index} = {sympy.latex(value)}"
+            for index, value in enumerate(sorted(solution, key=lambda value: float(sympy.N(value))), start=1)
+        )
+        steps.append(
+            f"Vì $\\Delta > 0$ nên phương trình có hai nghiệm phân biệt "
+            f"${variable}_{{1,2}} = \\frac{{-b \\pm \\sqrt{{\\Delta}}}}{{2a}}$, tức là ${roots}$."
+        )
+    else:
+        return None
+    return steps
+
+
+def _inequality_steps(problem: MathProblem, solution: Any) -> Optional[List[str]]:
+    variable = problem.variables[0]
+    relation = problem.expressions[0]
+    if relation.rel_op not in INEQUALITY_SIGNS:
+        return None
+    (a,), c = _linear_terms(relation, problem.variables)
+    sign = relation.rel_op
+    steps = [
+        f"Chuyển các hạng tử chứa ${variable}$ sang vế trái, hằng số sang vế phải rồi thu gọn: "
+        f"${sympy.latex(a * variable)} {INEQUALITY_SIGNS[sign]} {sympy.latex(c)}$."
+    ]
+    if a.is_positive and a != 1:
+        steps.append(
+            f"Chia hai vế cho ${sympy.latex(a)} > 0$, giữ nguyên chiều bất đẳng thức: "
+            f"${variable} {INEQUALITY_SIGNS[sign]} {sympy.latex(c / a)}$."
+        )
+    elif a.is_negative:
+        steps.append(
+            f"Chia hai vế cho ${sympy.latex(a)} < 0$, đổi chiều bất đẳng thức: "
+            f"${variable} {INEQUALITY_SIGNS[FLIPPED_SIGNS[sign]]} {sympy.latex(c / a)}$."
+        )
+    elif a != 1:
+        return None
+    return steps
+
+
+def _system_steps(problem: MathProblem, solution: Any) -> Optional[List[str]]:
+    x, y = problem.variables
+    (a1, b1), c1 = _linear_terms(problem.expressions[0], problem.variables)
+    (a2, b2), c2 = _linear_terms(problem.expressions[1], problem.variables)
+    y_coefficient = sympy.simplify(a2 * b1 - a1 * b2)
+    # Hệ suy biến hoặc khuyết ẩn: mẫu lời giải cộng đại số không còn tự nhiên, để Gemini giải
+    if a1 == 0 or a2 == 0 or y_coefficient == 0:
+        return None
+
+    if a1 == a2:
+        elimination, coefficient, constant = "Trừ vế theo vế (1) cho (2) để khử", b1 - b2, c1 - c2
+    elif a1 == -a2:
+        elimination, coefficient, constant = "Cộng vế theo vế (1) và (2) để khử", b1 + b2, c1 + c2
+    else:
+        multipliers = [f"của ({label}) với ${sympy.latex(factor)}$" for label, factor in ((1, a2), (2, a1)) if factor != 1]
+        elimination = f"Nhân hai vế {', '.join(multipliers)} rồi trừ vế theo vế để khử"
+        coefficient, constant = y_coefficient, a2 * c1 - a1 * c2
+    y_value = sympy.simplify(constant / coefficient)
+    x_value = sympy.simplify((c1 - b1 * y_value) / a1)
+    first = f"{sympy.latex(a1 * x + b1 * y)} = {sympy.latex(c1)}"
+    second = f"{sympy.latex(a2 * x + b2 * y)} = {sympy.latex(c2)}"
+    return [
+        f"Viết hệ dưới dạng $\\begin{{cases}} {first} & (1) \\\\ {second} & (2) \\end{{cases}}$ và giải bằng phương pháp cộng đại số.",
+        f"{elimination} ${x}$: ${sympy.latex(sympy.simplify(coefficient) * y)} = {sympy.latex(sympy.simplify(constant))}$, "
+        f"suy ra ${y} = {sympy.latex(y_value)}$.",
+        f"Thay ${y} = {sympy.latex(y_value)}$ vào (1) ta được ${x} = {sympy.latex(x_value)}$.",
+    ]
+
+
+def _drop_unit_factors(expression: Any) -> Any:
+    """Bỏ thừa số 1 mà parse_expr (evaluate=False) sinh ra cho phép chia: 1/√2 là Mul(1, 1/√2), hiển thị thành "1 \\frac{1}{\\sqrt{2}}"."""
+    if not expression.args:
+        return expression
+    args = [_drop_unit_factors(arg) for arg in expression.args]
+    if isinstance(expression, sympy.Mul):
+        args = [arg for arg in args if arg != 1] or [sympy.Integer(1)]
+        if len(args) == 1:
+            return args[0]
+    return expression.func(*args, evaluate=False)
+
+
+def _written_latex(problem: MathProblem) -> Optional[str]:
+    """LaTeX của biểu thức đúng như thứ tự viết trong đề (không để sympy thu gọn hay sắp xếp lại)."""
+    for segment in math_segments(problem.statement):
+        for piece in _pieces(segment):
+            piece = re.sub(r"^\s*[A-Z]\s*=", "", piece)
+            if "sqrt" in piece and not RELATION.search(piece):
+                original = parse_expression(piece, evaluate=False)
+                if original is not None:
+                    return sympy.latex(_drop_unit_factors(original), order="none")
+    return None
+
+
+def _radical_steps(problem: MathProblem, solution: Any) -> Optional[List[str]]:
+    written, simplified = _written_latex(problem), sympy.latex(solution)
+    if written is None:
+        return None
+    if written == simplified:
+        return [f"Biểu thức ${written}$ đã ở dạng thu gọn."]
+    return [f"Đưa thừa số ra ngoài dấu căn, trục căn thức ở mẫu và thu gọn các căn đồng dạng: ${written} = {simplified}$."]
+
+
+STEP_BUILDERS = {
+    INEQUALITY: _inequality_steps,
+    SYSTEM: _system_steps,
+    RADICAL: _radical_steps,
+}
+
+
+def explain_solution(problem: MathProblem, solution: Any) -> Optional[str]:
+    """Lời giải từng bước theo mẫu, kết thúc bằng "Vậy ..."; None nếu mẫu không áp dụng được."""
+    if problem.kind == EQUATION:
+        builder = _linear_steps if _degree(problem.expressions[0], problem.variables) == 1 else _quadratic_steps
+    else:
+        builder = STEP_BUILDERS[problem.kind]
+    steps = builder(problem, solution)
+    if steps is None:
+        return None
+    lines = [f"**Bước {index}.** {step}" for index, step in enumerate(steps, start=1)]
+    lines.append(f"**Vậy** {format_solution(problem, solution)}.")
+    return "\n\n".join(lines)
+
+
+class SymbolicSolver:
+    """
+    Đường tắt giải bằng sympy cho các bài tập tính toán cơ bản (phương trình bậc nhất/bậc hai,
+    hệ hai phương trình bậc nhất, bất phương trình bậc nhất, rút gọn biểu thức căn).
+    Chỉ nhận đề ngắn, mở đầu bằng yêu cầu giải/tìm/tính/rút gọn; mọi trường hợp khác trả về None
+    để câu hỏi đi qua pipeline retrieval + Gemini như bình thường.
+    """
+
+    def __init__(self, max_length: int = FAST_PATH_MAX_LENGTH):
+        self.max_length = max_length
+        self._lock = threading.Lock()
+        self._stats = {"attempts": 0, "solved": 0, "fallthrough": 0, "total_ms": 0.0}
+
+    def answer(self, query: str) -> Optional[str]:
+        start = time.perf_counter()
+        reply = None
+        try:
+            if len(query) <= self.max_length and FAST_PATH_REQUEST.match(query) and not FAST_PATH_EXCLUDED.search(query):
+                problem = parse_problem(query)
+                if problem is not None:
+                    reply = explain_solution(problem, problem.solve())
+        except Exception as e:
+            print(f"DEBUG: [Symbolic Solver] Could not solve symbolically: {e}")
+            reply = None
+
+        with self._lock:
+            self._stats["attempts"] += 1
+            self._stats["solved" if reply is not None else "fallthrough"] += 1
+            self._stats["total_ms"] += (time.perf_counter() - start) * 1000
+        return reply
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            attempts = self._stats["attempts"]
+            return {
+                "attempts": attempts,
+                "solved": self._stats["solved"],
+                "fallthrough": self._stats["fallthrough"],
+                "solve_rate": self._stats["solved"] / attempts if attempts else 0.0,
+                "avg_ms": self._stats["total_ms"] / attempts if attempts else 0.0,
+            }
@@ -0,0 +1,361 @@
+import re
+import time
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from haystack import Document, component
+
+from corpus_utils import Corpus, normalize_rows
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Chỉ số top-k theo từng dòng của `scores` (b, n), đã sắp xếp giảm dần."""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+class IVFIndex:
+    """
+    Chỉ mục ANN dạng IVF (inverted file) thuần NumPy.
+    Spherical k-means chia corpus thành `n_lists` cụm; khi truy vấn chỉ chấm điểm các tài liệu
+    thuộc `nprobe` cụm gần nhất. Tăng `nprobe` để tăng recall, giảm để giảm độ trễ.
+    `fingerprint` là dấu vân tay của corpus lúc xây chỉ mục (Corpus.fingerprint), dùng để phát hiện chỉ mục cũ.
+    """
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_indices: np.ndarray, nprobe: int = 8, fingerprint: Optional[str] = None):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_indices = list_indices
+        self.nprobe = nprobe
+        self.fingerprint = fingerprint
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def size(self) -> int:
+        return len(self.list_indices)
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, n_lists: Optional[int] = None, n_iter: int = 20, seed: int = 0, nprobe: int = 8, fingerprint: Optional[str] = None) -> "IVFIndex":
+        """Huấn luyện k-means trên embedding của corpus (chạy offline)."""
+        matrix = normalize_rows(embeddings)
+        n = len(matrix)
+        n_lists = max(1, min(n_lists or int(np.sqrt(n)), n))
+        rng = np.random.default_rng(seed)
+
+        centroids = matrix[rng.choice(n, size=n_lists, replace=False)].copy()
+        assignments = np.zeros(n, dtype=np.int64)
+        for _ in range(n_iter):
+            assignments = np.argmax(matrix @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = matrix[assignments == c]
+                # Cụm rỗng: khởi tạo lại bằng một điểm ngẫu nhiên
+                centroids[c] = members.mean(axis=0) if len(members) else matrix[rng.integers(n)]
+            centroids = normalize_rows(centroids)
+        assignments = np.argmax(matrix @ centroids.T, axis=1)
+
+        list_indices = np.argsort(assignments, kind="stable")
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+        return cls(centroids, list_offsets.astype(np.int64), list_indices.astype(np.int64), nprobe=nprobe, fingerprint=fingerprint)
+
+    def search(self, matrix: np.ndarray, queries: np.ndarray, k: int, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Tìm top-k cho các truy vấn đã chuẩn hóa; `matrix` là ma trận embedding đã chuẩn hóa của corpus.
+        Trả về (indices, scores) shape (b, k), các dòng thiếu ứng viên được đệm bằng -1 / -inf.
+        """
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        probes = top_k_indices(queries @ self.centroids.T, nprobe)
+
+        all_indices = np.full((len(queries), k), -1, dtype=np.int64)
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for row, (query, lists) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([
+                self.list_indices[self.list_offsets[c]:self.list_offsets[c + 1]] for c in lists
+            ])
+            if not len(candidates):
+                continue
+            scores = matrix[candidates] @ query
+            best = top_k_indices(scores[None, :], k)[0]
+            all_indices[row, :len(best)] = candidates[best]
+            all_scores[row, :len(best)] = scores[best]
+        return all_indices, all_scores
+
+    def save(self, path: str):
+        np.savez(
+            path, centroids=self.centroids, list_offsets=self.list_offsets, list_indices=self.list_indices,
+            nprobe=self.nprobe, fingerprint=self.fingerprint or "",
+        )
+
+    @classmethod
+    def load(cls, path: str, nprobe: Optional[int] = None) -> "IVFIndex":
+        data = np.load(path)
+        fingerprint = str(data["fingerprint"]) if "fingerprint" in data.files else ""
+        return cls(
+            data["centroids"], data["list_offsets"], data["list_indices"],
+            nprobe=int(nprobe or data["nprobe"]), fingerprint=fingerprint or None,
+        )
+
+
+def recall_report(
+    embeddings: np.ndarray,
+    index: IVFIndex,
+    queries: np.ndarray,
+    k: int = 10,
+    nprobe_values: Sequence[int] = (1, 2, 4, 8, 16),
+) -> List[Dict[str, float]]:
+    """So sánh recall@k và độ trễ trung bình của IVF với tìm kiếm chính xác cho từng giá trị nprobe."""
+    matrix = normalize_rows(embeddings)
+    queries = normalize_rows(np.atleast_2d(queries))
+
+    start = time.perf_counter()
+    exact = top_k_indices(queries @ matrix.T, k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = []
+    for nprobe in nprobe_values:
+        start = time.perf_counter()
+        approx, _ = index.search(matrix, queries, k, nprobe=nprobe)
+        ann_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        hits = sum(len(set(e) & set(a)) for e, a in zip(exact.tolist(), approx.tolist()))
+        report.append({
+            "nprobe": min(nprobe, index.n_lists),
+            "recall_at_k": hits / exact.size,
+            "exact_ms_per_query": exact_ms,
+            "ann_ms_per_query": ann_ms,
+        })
+    return report
+
+
+@component
+class NumpyEmbeddingRetriever:
+    """
+    Retriever vector hóa: chấm điểm trực tiếp trên ma trận embedding đã chuẩn hóa của corpus (memmap),
+    chấm điểm một truy vấn (hoặc một batch truy vấn) bằng một phép nhân ma trận và chọn top-k bằng argpartition.
+    Thay thế trực tiếp cho InMemoryEmbeddingRetriever (cùng input/output), điểm số là cosine.
+    Nếu có `ann_index`, chỉ quét các cụm gần nhất thay vì toàn bộ corpus.
+    """
+
+    def __init__(self, corpus: Corpus, top_k: int = 10, ann_index: Optional[IVFIndex] = None):
+        self.corpus = corpus
+        self.top_k = top_k
+        if corpus.normalized:
+            self.matrix = corpus.embeddings
+        else:
+            print("WARNING: [Retriever] Corpus embeddings are not normalized; copying into RAM (re-export the corpus to avoid this)")
+            self.matrix = normalize_rows(corpus.embeddings)
+        if ann_index is not None and ann_index.size != len(corpus):
+            print(f"WARNING: [Retriever] ANN index covers {ann_index.size} documents but corpus has {len(corpus)}; using exact search")
+            ann_index = None
+        elif ann_index is not None and ann_index.fingerprint != corpus.fingerprint():
+            # Chỉ mục được xây cho một phiên bản corpus khác: số thứ tự trong các cụm không còn đúng
+            print("WARNING: [Retriever] ANN index was built for a different corpus (rebuild with build-index); using exact search")
+            ann_index = None
+        self.ann_index = ann_index
+
+    def search(self, query_embeddings: Sequence[Sequence[float]], top_k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Trả về (indices, scores) có shape (b, k) cho một batch truy vấn."""
+        queries = normalize_rows(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        if self.ann_index is not None:
+            return self.ann_index.search(self.matrix, queries, top_k or self.top_k)
+        scores = queries @ self.matrix.T
+        indices = top_k_indices(scores, top_k or self.top_k)
+        return indices, np.take_along_axis(scores, indices, axis=1)
+
+    @component.output_types(documents=List[Document])
+    def run(self, query_embedding: List[float], top_k: Optional[int] = None):
+        return {"documents": self.run_batch([query_embedding], top_k=top_k)["documents"][0]}
+
+    def run_batch(self, query_embeddings: List[List[float]], top_k: Optional[int] = None):
+        """Truy xuất cho nhiều truy vấn trong một lần gọi BLAS."""
+        indices, scores = self.search(query_embeddings, top_k)
+        return {
+            "documents": [
+                [self.corpus.document(int(i), score=float(s)) for i, s in zip(row_indices, row_scores) if i >= 0]
+                for row_indices, row_scores in zip(indices, scores)
+            ]
+        }
+
+
+# Từ (kể cả chữ số mũ như b²), số hiệu mục "§3" và các ký hiệu toán mang nghĩa
+TOKEN_PATTERN = re.compile(r"§\s*\d+|\w+|[δ∆√π≤≥≠±=]", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Tách từ cho BM25, giữ lại ký hiệu toán để khớp chính xác công thức."""
+    text = unicodedata.normalize("NFC", text or "").lower()
+    return [token.replace(" ", "") for token in TOKEN_PATTERN.findall(text)]
+
+
+class BM25Index:
+    """
+    Chỉ mục BM25 tính sẵn một lần khi khởi động: trọng số BM25 của từng (term, document)
+    được lưu trong posting list nên mỗi truy vấn chỉ còn là phép cộng các posting.
+    """
+
+    def __init__(self, contents: Sequence[str], k1: float = 1.5, b: float = 0.75):
+        tokenized = [tokenize(content) for content in contents]
+        n_docs = len(tokenized)
+        doc_lengths = np.array([len(tokens) for tokens in tokenized], dtype=np.float32)
+        avg_length = float(doc_lengths.mean()) if n_docs else 0.0
+        length_norm = k1 * (1 - b + b * doc_lengths / max(avg_length, 1e-9))
+
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        for doc_idx, tokens in enumerate(tokenized):
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_idx, tf))
+
+        self.n_docs = n_docs
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for term, entries in postings.items():
+            doc_ids = np.array([doc_idx for doc_idx, _ in entries], dtype=np.int64)
+            tfs = np.array([tf for _, tf in entries], dtype=np.float32)
+            idf = np.log(1 + (n_docs - len(entries) + 0.5) / (len(entries) + 0.5))
+            weights = idf * tfs * (k1 + 1) / (tfs + length_norm[doc_ids])
+            self.postings[term] = (doc_ids, weights.astype(np.float32))
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term in self.postings:
+                doc_ids, weights = self.postings[term]
+                scores[doc_ids] += weights
+        return scores
+
+    def search(self, query: str, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Trả về (indices, scores) của các tài liệu có điểm > 0, tối đa top_k."""
+        scores = self.scores(query)
+        indices = top_k_indices(scores[None, :], top_k)[0]
+        indices = indices[scores[indices] > 0]
+        return indices, scores[indices]
+
+
+@component
+class HybridRetriever:
+    """
+    Truy xuất lai: chạy BM25 và embedding song song rồi hợp nhất thứ hạng bằng
+    Reciprocal Rank Fusion (điểm = tổng 1 / (rrf_k + hạng)).
+    BM25 bắt được các khớp chính xác về ký hiệu như "Δ = b² − 4ac" hay "§3" mà embedding bỏ sót.
+    """
+
+    def __init__(
+        self,
+        embedding_retriever: NumpyEmbeddingRetriever,
+        bm25_index: BM25Index,
+        top_k: int = 5,
+        candidate_k: int = 20,
+        rrf_k: int = 60,
+    ):
+        self.embedding_retriever = embedding_retriever
+        self.bm25_index = bm25_index
+        self.corpus = embedding_retriever.corpus
+        self.top_k = top_k
+        self.candidate_k = candidate_k
+        self.rrf_k = rrf_k
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hybrid-retriever")
+
+    @component.output_types(documents=List[Document])
+    def run(self, query: str, query_embedding: List[float], top_k: Optional[int] = None):
+        dense_future = self._executor.submit(self.embedding_retriever.search, [query_embedding], self.candidate_k)
+        sparse_future = self._executor.submit(self.bm25_index.search, query, self.candidate_k)
+        dense_indices = [int(i) for i in dense_future.result()[0][0] if i >= 0]
+        sparse_indices = [int(i) for i in sparse_future.result()[0]]
+
+        fused: Dict[int, float] = {}
+        for ranking in (dense_indices, sparse_indices):
+            for rank, doc_idx in enumerate(ranking, start=1):
+                fused[doc_idx] = fused.get(doc_idx, 0.0) + 1.0 / (self.rrf_k + rank)
+
+        best = sorted(fused.items(), key=lambda item: item[1], reverse=True)[: top_k or self.top_k]
+        return {"documents": [self.corpus.document(doc_idx, score=score) for doc_idx, score in best]}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Ước lượng số token cục bộ (không gọi API): mỗi từ/âm tiết tiếng Việt khoảng 1.3 token,
+    mỗi ký hiệu/dấu câu 1 token.
+    """
+    words = len(re.findall(r"\w+", text or ""))
+    symbols = len(re.findall(r"[^\w\s]", text or ""))
+    return int(words * 1.3 + symbols) + 1
+
+
+@component
+class ContextPacker:
+    """
+    Đóng gói tài liệu truy xuất vào prompt của informer theo ngân sách token:
+    loại bỏ các đoạn trùng/chồng lấn, sắp theo điểm và nhét đến khi hết ngân sách.
+    Ghi lại số token tiết kiệm được cho mỗi yêu cầu.
+    """
+
+    def __init__(self, token_budget: int = 1500, overlap_threshold: float = 0.8):
+        self.token_budget = token_budget
+        self.overlap_threshold = overlap_threshold
+        self._lock = threading.Lock()
+        self._totals = {"requests": 0, "tokens_in": 0, "tokens_out": 0}
+
+    @component.output_types(documents=List[Document], stats=Dict[str, int])
+    def run(self, documents: List[Document], token_budget: Optional[int] = None):
+        budget = token_budget or self.token_budget
+        ranked = sorted(documents, key=lambda doc: doc.score if doc.score is not None else 0.0, reverse=True)
+        tokens_in = sum(estimate_tokens(doc.content) for doc in documents)
+
+        packed, kept_shingles, seen_hashes = [], [], set()
+        tokens_out = duplicates = 0
+        for doc in ranked:
+            content = doc.content or ""
+            content_hash = hashlib.sha1(" ".join(content.split()).encode("utf-8")).hexdigest()
+            shingles = _shingles(content)
+            if content_hash in seen_hashes or any(_overlap(shingles, kept) >= self.overlap_threshold for kept in kept_shingles):
+                duplicates += 1
+                continue
+
+            doc_tokens = estimate_tokens(content)
+            if tokens_out + doc_tokens > budget:
+                # Đoạn này không vừa, thử các đoạn ngắn hơn phía sau
+                continue
+            packed.append(doc)
+            seen_hashes.add(content_hash)
+            kept_shingles.append(shingles)
+            tokens_out += doc_tokens
+
+        stats = {
+            "documents_in": len(documents),
+            "documents_out": len(packed),
+            "duplicates": duplicates,
+            "tokens_in": tokens_in,
+            "tokens_out": tokens_out,
+            "tokens_saved": tokens_in - tokens_out,
+        }
+        with self._lock:
+            self._totals["requests"] += 1
+            self._totals["tokens_in"] += tokens_in
+            self._totals["tokens_out"] += tokens_out
+        return {"documents": packed, "stats": stats}
+
+    def totals(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._totals, "tokens_saved": self._totals["tokens_in"] - self._totals["tokens_out"]}
+
+
+def _shingles(text: str, size: int = 5) -> set:
+    words = (text or "").lower().split()
+    return {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+def _overlap(a: set, b: set) -> float:
+    """Tỉ lệ chồng lấn: phần giao chia cho tập nhỏ hơn (bắt cả trường hợp đoạn này nằm trong đoạn kia)."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
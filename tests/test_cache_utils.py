@@ -0,0 +1,59 @@
+import io
+
+import numpy as np
+import pytest
+
+pytest.importorskip("haystack")
+Image = pytest.importorskip("PIL.Image")
+ImageDraw = pytest.importorskip("PIL.ImageDraw")
+ImageFont = pytest.importorskip("PIL.ImageFont")
+
+from cache_utils import OcrCache
+from image_utils import ImagePreprocessor, content_digest
+
+
+def _worksheet(equations, quality=90, size=(1512, 2016)):
+    """Ảnh chụp phiếu bài tập giả lập: cùng tiêu đề/bố cục, chỉ khác các phương trình."""
+    sheet = Image.new("L", (1512, 2016), 235)
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.load_default(size=36)
+    draw.text((150, 100), "PHIẾU BÀI TẬP - TOÁN 8", fill=20, font=font)
+    for i, equation in enumerate(equations):
+        draw.text((150, 250 + i * 150), f"Bài {i + 1}. Giải phương trình {equation}", fill=20, font=font)
+    noise = np.random.default_rng(0).normal(0, 6, (2016, 1512))
+    sheet = Image.fromarray(np.clip(np.asarray(sheet) + noise, 0, 255).astype(np.uint8)).resize(size)
+    buffer = io.BytesIO()
+    sheet.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def _key(preprocessor, image_bytes):
+    return content_digest(image_bytes), preprocessor.fingerprint(image_bytes)
+
+
+def test_ocr_cache_tells_same_layout_sheets_apart(tmp_path):
+    preprocessor = ImagePreprocessor()
+    cache = OcrCache(path=str(tmp_path / "ocr.sqlite3"))
+
+    first = _worksheet(["x + 5 = 10", "2x - 3 = 7", "x^2 = 9"])
+    cache.store(*_key(preprocessor, first), "x + 5 = 10; 2x - 3 = 7; x^2 = 9")
+
+    second = _worksheet(["x + 7 = 12", "2x - 3 = 7", "x^2 = 9"])
+    assert cache.lookup(*_key(preprocessor, second)) is None
+
+
+def test_ocr_cache_reuses_resaved_image(tmp_path):
+    preprocessor = ImagePreprocessor()
+    cache = OcrCache(path=str(tmp_path / "ocr.sqlite3"))
+
+    original = _worksheet(["x + 5 = 10", "2x - 3 = 7"])
+    cache.store(*_key(preprocessor, original), "x + 5 = 10; 2x - 3 = 7")
+
+    assert cache.lookup(*_key(preprocessor, original)) == "x + 5 = 10; 2x - 3 = 7"
+    recompressed = _worksheet(["x + 5 = 10", "2x - 3 = 7"], quality=60)
+    assert cache.lookup(*_key(preprocessor, recompressed)) == "x + 5 = 10; 2x - 3 = 7"
+    downscaled = _worksheet(["x + 5 = 10", "2x - 3 = 7"], quality=80, size=(1008, 1344))
+    assert cache.lookup(*_key(preprocessor, downscaled)) == "x + 5 = 10; 2x - 3 = 7"
+
+    stats = cache.stats()
+    assert stats["exact_hits"] == 1 and stats["near_hits"] == 2
@@ -0,0 +1,122 @@
+import pytest
+
+from math_utils import SymbolicSolver, verify_solution
+
+
+@pytest.mark.parametrize(
+    "problem, answer, expected",
+    [
+        ("Giải phương trình: $(x+5)(3x-9)=0$.", "... Vậy phương trình đã cho có hai nghiệm là $x=-5$ và $x=3$.", True),
+        ("Giải phương trình: $(x+5)(3x-9)=0$.", "... Vậy phương trình có nghiệm $x=-5$ và $x=4$.", False),
+        ("Giải phương trình x + 5 = 10", "Ta có x = 10 - 5. Vậy x = 5", True),
+        ("Giải phương trình x^2 - 5x + 6 = 0", "**Kết luận:** $x_1 = 2$, $x_2 = 3$", True),
+        ("giải pt x² + 1 = 0", "Vậy phương trình vô nghiệm.", True),
+        ("Giải phương trình 2x^2 - 3x - 5 = 0", "Vậy $S = \\{-1; \\frac{5}{2}\\}$", True),
+        ("Giải phương trình 2x^2 + 3x - 5 = 0", "Vậy tập nghiệm $S = \\{1; 2\\}$", False),
+        (
+            "Giải hệ phương trình: $\\begin{cases} 2x+y=5 \\quad (1) \\\\ 3x-2y=11 \\quad (2) \\end{cases}$",
+            "Vậy hệ phương trình đã cho có nghiệm $(x; y) = (3; -1)$.",
+            True,
+        ),
+        ("Giải hệ phương trình: $\\begin{cases} 2x+y=5 \\\\ 3x-2y=11 \\end{cases}$", "Vậy $x = 3$, $y = 1$", False),
+        ("Giải hệ phương trình: $\\begin{cases} 12x-4y=-16 \\\\ 3x-y=-4 \\end{cases}$", "Vậy hệ phương trình đã cho có vô số nghiệm.", True),
+        ("Giải bất phương trình: $3x-5-2x > 25+4x$.", "Vậy nghiệm của bất phương trình là $x < -10$.", True),
+        ("Giải bất phương trình: $3x-5-2x > 25+4x$.", "Vậy $S = \\{x \\mid x > -10\\}$", False),
+        ("Rút gọn biểu thức: $B = (\\sqrt{12} + 2\\sqrt{3} - \\sqrt{27}) \\cdot \\sqrt{3}$", "... Vậy $B = 3$.", True),
+        ("Rút gọn $A = \\sqrt{40^2 - 24^2}$", "Vậy $A = 30$", False),
+    ],
+)
+def test_verify_solution_verdicts(problem, answer, expected):
+    result = verify_solution(problem, answer)
+    assert result is not None
+    assert result["is_correct"] is expected
+
+
+@pytest.mark.parametrize(
+    "problem, answer",
+    [
+        # Các khối kết luận mâu thuẫn nhau: không được kết luận "sai"
+        ("Giải phương trình x^2 = 9", "Vậy x = 3 hoặc x = -3. Kết quả cho thấy x = 3 thỏa mãn"),
+        ("Giải phương trình 2x^2 + 3x - 5 = 0", "$S = \\{1; -5/2\\}$. Đáp số: x = 1"),
+        # Đề giới hạn tập nghiệm hoặc có yêu cầu thêm: tập nghiệm thực không phải đáp số
+        ("Tìm nghiệm nguyên của phương trình 2x^2 + 3x - 5 = 0", "Vậy x = 1"),
+        ("Tìm nghiệm nguyên của phương trình 2x^2 + 3x - 5 = 0", "Vậy x = 1 hoặc x = -5/2"),
+        ("Giải phương trình x^2 = 9 trong tập số tự nhiên", "Vậy x = 3"),
+        ("Giải phương trình x^2 - 5x + 6 = 0 rồi tính tổng hai nghiệm", "Vậy tổng hai nghiệm là 5"),
+        # Bài toán có lời văn chứa đúng một hằng số có căn: không phải bài rút gọn biểu thức
+        ("Tính cạnh huyền của tam giác vuông có hai cạnh góc vuông là 1 và √3", "... Vậy cạnh huyền bằng 2."),
+        ("Tính bán kính đường tròn ngoại tiếp tam giác đều cạnh 2√3", "Vậy R = 2"),
+        ("Tính chu vi hình vuông có cạnh √3 cm", "Vậy chu vi bằng 4√3 cm"),
+        # Đáp số không đọc được trọn vẹn
+        ("Giải phương trình x^2 = 9", "Vậy x = 3 hoặc x = \\frac{a}{2}"),
+        # Không đọc được đề
+        ("Giải phương trình $\\frac{1}{x} = 2$", "Vậy x = 1/2"),
+        ("Giải phương trình 9^9^9^9 = x", "Vậy x = 1"),
+        ("Giải phương trình __import__('os') = x", "Vậy x = 1"),
+    ],
+)
+def test_verify_solution_defers_to_llm(problem, answer):
+    assert verify_solution(problem, answer) is None
+
+
+@pytest.mark.parametrize(
+    "query, conclusion",
+    [
+        ("Giải phương trình x + 5 = 10", "**Vậy** phương trình có nghiệm $x = 5$."),
+        ("Tìm x biết 2x + 3 = 5", "**Vậy** phương trình có nghiệm $x = 1$."),
+        ("Giải phương trình 2,5x = 5", "**Vậy** phương trình có nghiệm $x = 2$."),
+        ("Giải phương trình 0.5x + 1.25 = 2", "**Vậy** phương trình có nghiệm $x = \\frac{3}{2}$."),
+        ("Giải phương trình x^2 - 5x + 6 = 0", "**Vậy** phương trình có hai nghiệm $x = 2$ và $x = 3$."),
+        ("Giải phương trình x^2 + 1 = 0", "**Vậy** phương trình vô nghiệm."),
+        ("Giải bất phương trình -2x + 3 > 7", "**Vậy** nghiệm của bất phương trình là $x < -2$."),
+        ("Giải hệ phương trình 2x + 3y = 7; 3x - 2y = 4", "**Vậy** hệ phương trình có nghiệm $(x; y) = (2; 1)$."),
+        ("Rút gọn biểu thức $\\sqrt{8} + \\sqrt{18}$", "**Vậy** biểu thức có giá trị $5 \\sqrt{2}$."),
+    ],
+)
+def test_symbolic_solver_answers(query, conclusion):
+    answer = SymbolicSolver().answer(query)
+    assert answer is not None
+    assert answer.endswith(conclusion)
+    # Lời giải của đường tắt phải qua được verifier
+    assert verify_solution(query, answer)["is_correct"] is True
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "Tính giá trị của biểu thức 2x + 1 tại x = 3",
+        "Tính x^2 + 1 khi x = 2",
+        "Tính 2x + 1 với x = 3",
+        "Tìm nghiệm nguyên của phương trình 2x + 3 = 8",
+        "Giải phương trình x^2 - 5x + 6 = 0 trong tập số tự nhiên",
+        "Giải phương trình x^2 - 5x + 6 = 0 rồi tính tổng hai nghiệm",
+        "Tính 1/0 + sqrt(2)",
+        "Rút gọn sqrt(-4)",
+        "Rút gọn sqrt(x^2)",
+        "Giải thích cách giải x + 5 = 10",
+        "Tìm m để phương trình x^2 - 2x + m = 0 có nghiệm",
+        "Giải phương trình x^2 - 5x + 6 = 0 bằng cách phân tích nhân tử",
+        "Giải hệ phương trình y = 2 và x + y = 3",
+        # Bài toán có lời văn, hàm lượng giác hay đơn vị đứng cạnh công thức
+        "Tính chu vi hình vuông có cạnh √3 cm",
+        "Tính độ dài đường chéo của hình vuông cạnh 2√2",
+        "Tính cạnh huyền của tam giác vuông có hai cạnh góc vuông là 1 và √3",
+        "Tính sin 30 + √4",
+        "Tính $\\sqrt{3}$ cm + $\\sqrt{12}$ cm",
+        "Giải phương trình log x = 2",
+    ],
+)
+def test_symbolic_solver_falls_through(query):
+    assert SymbolicSolver().answer(query) is None
+
+
+@pytest.mark.parametrize(
+    "query, step",
+    [
+        ("Tính 1/√2", "$\\frac{1}{\\sqrt{2}} = \\frac{\\sqrt{2}}{2}$"),
+        ("Rút gọn √8 - 2√2", "$\\sqrt{8} - 2 \\sqrt{2} = 0$"),
+        ("Tính $\\frac{1}{\\sqrt{2}-1}$", "$\\frac{1}{\\sqrt{2} - 1} = 1 + \\sqrt{2}$"),
+    ],
+)
+def test_symbolic_solver_shows_expression_as_written(query, step):
+    assert step in SymbolicSolver().answer(query)